@@ -21,7 +21,6 @@ from panwid.listbox import ScrollingListBox
 from panwid.dropdown import *
 from panwid.dialog import *
 from panwid.tabview import *
-from pony.orm import db_session
 from tonyc_utils.logging import *
 
 import pytz
@@ -37,6 +36,8 @@ from .widgets import *
 
 from . import config
 from . import model
+from . import cache
+from . import writer
 from . import utils
 from . import session
 from . import providers
@@ -89,6 +90,12 @@ def quit_app():
     # tasks.stop_task_manager()
     state.asyncio_loop.create_task(state.task_manager.stop())
     state.task_manager_task.cancel()
+    state.cache_evictor_task.cancel()
+    state.db_maintenance_task.cancel()
+    # providers write buffered changes when they're deactivated
+    for p in providers.PROVIDERS.values():
+        p.deactivate()
+    writer.db_writer.stop()
 
     raise urwid.ExitMainLoop()
 
@@ -626,14 +633,9 @@ def main():
 
     providers.load()
 
-    model.init()
-
-    with db_session(optimistic=False):
-        model.MediaFeed.purge_all(
-            min_items = config.settings.profile.cache.min_items,
-            max_items = config.settings.profile.cache.max_items,
-            max_age = config.settings.profile.cache.max_age
-        )
+    database_config = config.settings.profile.get("database") or {}
+    model.init(database_config)
+    writer.db_writer.configure(database_config.get("writer"))
 
     spec = None
 
@@ -646,6 +648,16 @@ def main():
 
     state.task_manager_task = state.asyncio_loop.create_task(state.task_manager.start())
 
+    state.cache_evictor = cache.CacheEvictor.from_config(
+        config.settings.profile.cache
+    )
+    state.cache_evictor_task = state.asyncio_loop.create_task(
+        state.cache_evictor.run()
+    )
+    state.db_maintenance_task = state.asyncio_loop.create_task(
+        model.run_maintenance()
+    )
+
     log_file = os.path.join(config.CONFIG_DIR, f"{PACKAGE_NAME}.log")
     fh = logging.FileHandler(log_file)
     add_log_handler(fh)
@@ -0,0 +1,614 @@
+import logging
+logger = logging.getLogger(__name__)
+
+import os
+import zlib
+import sqlite3
+import argparse
+import hashlib
+import threading
+import time
+import asyncio
+from contextlib import closing
+from collections import OrderedDict
+from dataclasses import *
+from datetime import datetime, timedelta
+from urllib.parse import urlencode
+
+import bitmath
+import requests
+from requests.structures import CaseInsensitiveDict
+from orderedattrdict import AttrDict
+from pony.orm import *
+
+from .exceptions import *
+from . import writer
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from . import config
+from . import model
+from .utils import parse_size
+
+# Bodies smaller than this aren't worth compressing
+MIN_COMPRESS_SIZE = 256
+
+CODECS = AttrDict([
+    ("zlib", (
+        lambda b: zlib.compress(b, 6),
+        zlib.decompress
+    ))
+])
+
+if zstandard:
+    # compressor / decompressor objects aren't thread-safe, so make new ones
+    CODECS["zstd"] = (
+        lambda b: zstandard.ZstdCompressor(level=3).compress(b),
+        lambda b: zstandard.ZstdDecompressor().decompress(b)
+    )
+
+DEFAULT_CODEC = "zstd" if zstandard else "zlib"
+
+def compress(body, codec=DEFAULT_CODEC):
+    """
+    Compress a response body, returning the codec actually used ("" if the
+    body was left as-is) and the stored bytes.
+    """
+    if not codec or len(body) < MIN_COMPRESS_SIZE:
+        return ("", body)
+    data = CODECS[codec][0](body)
+    if len(data) >= len(body):
+        return ("", body)
+    return (codec, data)
+
+def decompress(codec, data):
+    if not codec:
+        return data
+    try:
+        return CODECS[codec][1](data)
+    except KeyError:
+        raise SGException(f"no decoder for cache codec {codec}")
+
+@dataclass
+class CachedResponse:
+    """
+    A response from the HTTP cache, detached from the database session it was
+    loaded in.
+    """
+
+    key: str
+    url: str
+    status: int
+    headers: dict
+    body: bytes
+    etag: str = None
+    last_modified: str = None
+    last_seen: datetime = field(default_factory=datetime.now)
+
+    @classmethod
+    def from_entry(cls, e):
+        return cls(
+            key = e.key,
+            url = e.url,
+            status = e.status,
+            headers = dict(e.headers),
+            body = decompress(e.codec, e.body or b""),
+            etag = e.etag or None,
+            last_modified = e.last_modified or None,
+            last_seen = e.last_seen
+        )
+
+    @property
+    def size(self):
+        return len(self.body) + len(self.url) + len(self.key)
+
+    @property
+    def age(self):
+        return datetime.now() - self.last_seen
+
+    def is_fresh(self, duration):
+        return self.age < timedelta(seconds=duration)
+
+    @property
+    def validators(self):
+        """
+        Conditional request headers for revalidating this entry.
+        """
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+    def to_response(self):
+        response = requests.Response()
+        response.status_code = self.status
+        response.headers = CaseInsensitiveDict(self.headers)
+        response.encoding = requests.utils.get_encoding_from_headers(
+            response.headers
+        )
+        response.url = self.url
+        response._content = self.body
+        response.from_cache = True
+        return response
+
+
+class MemoryCache(object):
+    """
+    Size-bounded, thread-safe LRU cache of CachedResponse objects.  Entries are
+    evicted least-recently-used first once the total size of the cached bodies
+    exceeds max_size bytes.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, entry):
+        if entry.size > self.max_size:
+            # too big to keep, but the entry it replaces is now out of date
+            self.remove(entry.key)
+            return
+        with self.lock:
+            old = self.entries.pop(entry.key, None)
+            if old is not None:
+                self.size -= old.size
+            self.entries[entry.key] = entry
+            self.size += entry.size
+            while self.size > self.max_size:
+                (_, evicted) = self.entries.popitem(last=False)
+                self.size -= evicted.size
+                self.evictions += 1
+
+    def remove(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.size -= entry.size
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    @property
+    def stats(self):
+        return AttrDict(
+            entries = len(self.entries),
+            size = self.size,
+            max_size = self.max_size,
+            hits = self.hits,
+            misses = self.misses,
+            evictions = self.evictions
+        )
+
+
+class HTTPCache(object):
+    """
+    Revalidating HTTP response cache backed by the CacheEntry table.
+
+    Entries are keyed on the request method, URL, query parameters, request
+    headers (other than the conditional ones in IGNORED_HEADERS) and any other
+    request options that can change the response.  Stale entries with an ETag
+    or Last-Modified validator are revalidated with a conditional request, and
+    a 304 response refreshes the stored entry instead of replacing it.
+
+    Lookups go through an in-memory LRU tier first, and writes go to both the
+    memory tier and the database.
+    """
+
+    MEMORY_CACHE_SIZE = "32MB"
+
+    CACHEABLE_METHODS = {"GET"}
+
+    CACHEABLE_STATUSES = {200, 203}
+
+    # added when revalidating, so they can't be part of the key
+    IGNORED_HEADERS = {"if-none-match", "if-modified-since"}
+
+    STORED_HEADERS = [
+        "Content-Type",
+        "Cache-Control",
+        "Date",
+        "Expires",
+        "ETag",
+        "Last-Modified",
+        "Vary",
+    ]
+
+    def __init__(self):
+        self._memory = None
+
+    @property
+    def memory(self):
+        if self._memory is None:
+            size = None
+            if config.settings:
+                size = config.settings.profile.get_path("cache.memory_size")
+            self._memory = MemoryCache(
+                parse_size(size or self.MEMORY_CACHE_SIZE)
+            )
+        return self._memory
+
+    @property
+    def stats(self):
+        return self.memory.stats
+
+    def key(self, method, url, params=None, headers=None, **options):
+        headers = CaseInsensitiveDict(headers or {})
+        if isinstance(params, dict):
+            params = sorted(params.items())
+        parts = [
+            method.upper(),
+            url,
+            urlencode(params or [], doseq=True),
+        ] + sorted(
+            f"{h.lower()}={v}"
+            for h, v in headers.items()
+            if v is not None and h.lower() not in self.IGNORED_HEADERS
+        ) + [
+            f"{k}={options[k]!r}"
+            for k in sorted(options)
+        ]
+        return hashlib.sha1("\n".join(parts).encode("utf-8")).hexdigest()
+
+    def is_cacheable(self, method, response):
+        return (
+            method.upper() in self.CACHEABLE_METHODS
+            and response.status_code in self.CACHEABLE_STATUSES
+            and "no-store" not in response.headers.get("Cache-Control", "")
+        )
+
+    def get(self, key):
+        entry = self.memory.get(key)
+        if entry is None:
+            entry = self.load(key)
+            if entry:
+                self.memory.put(entry)
+        return entry
+
+    @db_session
+    def load(self, key):
+        e = model.CacheEntry.get(key=key)
+        if not e:
+            return None
+        return CachedResponse.from_entry(e)
+
+    @staticmethod
+    def keep_until(last_seen, keep):
+        return last_seen + timedelta(seconds=keep) if keep else None
+
+    def put(self, key, response, keep=None):
+        """
+        Store a response.  If given, `keep` is how many seconds the entry can
+        still be used for, which the evictor won't remove it before.  The
+        memory tier is updated at once; the database row is written by the
+        database writer.
+        """
+        headers = {
+            h: response.headers[h]
+            for h in self.STORED_HEADERS
+            if h in response.headers
+        }
+        entry = CachedResponse(
+            key = key,
+            url = response.url,
+            status = response.status_code,
+            headers = headers,
+            body = response.content,
+            etag = response.headers.get("ETag"),
+            last_modified = response.headers.get("Last-Modified")
+        )
+        self.memory.put(entry)
+        writer.db_writer.submit(self.store, entry, keep)
+        return entry
+
+    def store(self, entry, keep=None):
+        (codec, body) = compress(entry.body)
+        model.CacheEntry.upsert(
+            dict(key = entry.key),
+            dict(
+                url = entry.url,
+                status = entry.status,
+                headers = entry.headers,
+                body = body,
+                codec = codec,
+                size = len(entry.body),
+                etag = entry.etag or "",
+                last_modified = entry.last_modified or "",
+                last_seen = entry.last_seen,
+                keep_until = self.keep_until(entry.last_seen, keep)
+            )
+        )
+
+    def touch(self, entry, keep=None):
+        """
+        Mark an entry as fresh again after a successful revalidation.
+        """
+        entry.last_seen = datetime.now()
+        writer.db_writer.submit(
+            self.store_last_seen, entry.key, entry.last_seen, keep
+        )
+        return entry
+
+    def store_last_seen(self, key, last_seen, keep=None):
+        e = model.CacheEntry.get(key=key)
+        if e:
+            e.last_seen = last_seen
+            e.keep_until = self.keep_until(last_seen, keep)
+
+
+http_cache = HTTPCache()
+
+
+class CacheEvictor(object):
+    """
+    Removes expired HTTP cache entries, enforces the total cache size limit
+    and purges old feed items in small batches from a background task, so
+    that none of this delays startup.
+
+    Each batch runs on a worker thread.  The batch size is adjusted after each
+    batch to keep it close to BATCH_TIME seconds.
+    """
+
+    BATCH_SIZE = 200
+    MIN_BATCH_SIZE = 10
+    MAX_BATCH_SIZE = 5000
+    BATCH_TIME = 0.05
+    BATCH_PAUSE = 0.1
+    INTERVAL = 600
+
+    def __init__(self, max_age=model.CACHE_DURATION_LONG, max_size=None,
+                 min_items=model.MediaFeed.DEFAULT_MIN_ITEMS,
+                 max_items=model.MediaFeed.DEFAULT_MAX_ITEMS,
+                 max_item_age=model.MediaFeed.DEFAULT_MAX_AGE):
+        self.max_age = max_age
+        self.max_size = max_size
+        self.min_items = min_items
+        self.max_items = max_items
+        self.max_item_age = max_item_age
+        self.batch_size = self.BATCH_SIZE
+        self.progress = AttrDict(
+            passes = 0,
+            running = False,
+            stage = None,
+            expired = 0,
+            evicted = 0,
+            feeds_purged = 0,
+            items_purged = 0,
+            feeds_total = 0,
+            last_pass = None,
+            last_pass_time = None
+        )
+
+    @classmethod
+    def from_config(cls, cfg):
+        return cls(
+            max_size = parse_size(cfg.get("max_size")),
+            min_items = cfg.get("min_items", model.MediaFeed.DEFAULT_MIN_ITEMS),
+            max_items = cfg.get("max_items", model.MediaFeed.DEFAULT_MAX_ITEMS),
+            max_item_age = cfg.get("max_age", model.MediaFeed.DEFAULT_MAX_AGE)
+        )
+
+    def delete_entries(self, entries):
+        """
+        Delete the given (id, key) cache entries through the database writer,
+        waiting for the delete to be committed.  Must not be called inside a
+        db_session, which would hold a read transaction open across it.
+        """
+        ids = [e_id for (e_id, key) in entries]
+        if ids:
+            writer.db_writer.write(
+                lambda: model.CacheEntry.select(
+                    lambda e: e.id in ids
+                ).delete(bulk=True)
+            )
+        for (e_id, key) in entries:
+            http_cache.memory.remove(key)
+        return len(entries)
+
+    def evict_expired(self, limit):
+        now = datetime.now()
+        cutoff = now - timedelta(seconds=self.max_age)
+        with db_session:
+            entries = [
+                (e.id, e.key)
+                for e in model.CacheEntry.select(
+                    lambda e: e.last_seen < cutoff
+                    and (e.keep_until is None or e.keep_until < now)
+                ).order_by(model.CacheEntry.last_seen)[:limit]
+            ]
+        return self.delete_entries(entries)
+
+    def evict_excess(self, limit):
+        if not self.max_size:
+            return 0
+        entries = []
+        with db_session:
+            (size,) = model.db.select(
+                "SELECT coalesce(sum(length(body)), 0) FROM CacheEntry"
+            )
+            excess = size - self.max_size
+            if excess <= 0:
+                return 0
+            for (e_id, key, stored) in model.db.select(
+                    "SELECT id, key, length(body) FROM CacheEntry"
+                    " ORDER BY last_seen LIMIT $limit"
+            ):
+                if excess <= 0:
+                    break
+                entries.append((e_id, key))
+                excess -= stored or 0
+        return self.delete_entries(entries)
+
+    def purge_feed(self, feed_id):
+        """
+        Purge one feed's old items through the database writer, waiting for
+        the purge to be committed.
+        """
+        def purge():
+            feed = model.MediaFeed.get(channel_id=feed_id)
+            if not feed:
+                return 0
+            return feed.purge(
+                min_items = self.min_items,
+                max_items = self.max_items,
+                max_age = self.max_item_age
+            )
+        return writer.db_writer.write(purge)
+
+    async def run_batches(self, stage, fn, counter):
+        """
+        Call fn(batch_size) on a worker thread until it returns less than a
+        full batch.
+        """
+        loop = asyncio.get_event_loop()
+        self.progress.stage = stage
+        while True:
+            batch_size = self.batch_size
+            start = time.monotonic()
+            count = await loop.run_in_executor(None, fn, batch_size)
+            elapsed = time.monotonic() - start
+            self.progress[counter] += count
+            if elapsed > self.BATCH_TIME:
+                self.batch_size = max(self.MIN_BATCH_SIZE, self.batch_size // 2)
+            elif elapsed < self.BATCH_TIME / 2:
+                self.batch_size = min(self.MAX_BATCH_SIZE, self.batch_size * 2)
+            if count < batch_size:
+                break
+            await asyncio.sleep(self.BATCH_PAUSE)
+
+    async def run_once(self):
+        loop = asyncio.get_event_loop()
+        start = time.monotonic()
+        self.progress.running = True
+        try:
+            await self.run_batches("expired", self.evict_expired, "expired")
+            await self.run_batches("size", self.evict_excess, "evicted")
+
+            self.progress.stage = "feeds"
+            with db_session:
+                feed_ids = list(select(f.channel_id for f in model.MediaFeed))
+            self.progress.feeds_total = len(feed_ids)
+            self.progress.feeds_purged = 0
+            for feed_id in feed_ids:
+                self.progress.items_purged += await loop.run_in_executor(
+                    None, self.purge_feed, feed_id
+                )
+                self.progress.feeds_purged += 1
+                await asyncio.sleep(self.BATCH_PAUSE)
+        finally:
+            self.progress.running = False
+            self.progress.stage = None
+        self.progress.passes += 1
+        self.progress.last_pass = datetime.now()
+        self.progress.last_pass_time = time.monotonic() - start
+        logger.info(f"cache eviction pass finished: {self.progress}")
+
+    async def run(self):
+        while True:
+            try:
+                await self.run_once()
+            except Exception as e:
+                logger.exception(e)
+            await asyncio.sleep(self.INTERVAL)
+
+
+@db_session
+def stats():
+    (entries, stored, size) = model.db.select(
+        "SELECT count(*), coalesce(sum(length(body)), 0),"
+        " coalesce(sum(size), 0) FROM CacheEntry"
+    )[0]
+    return AttrDict(
+        entries = entries,
+        stored = stored,
+        size = size,
+        ratio = (size / stored) if stored else None,
+        file_size = os.path.getsize(model.DB_FILE)
+    )
+
+@db_session
+def recompress(codec=DEFAULT_CODEC, batch_size=100):
+    """
+    Compress any cached bodies that were stored uncompressed.  Returns the
+    number of entries changed.
+    """
+    count = 0
+    last_id = 0
+    while True:
+        entries = model.CacheEntry.select(
+            lambda e: e.codec == "" and e.id > last_id
+        ).order_by(model.CacheEntry.id)[:batch_size]
+        if not entries:
+            break
+        for e in entries:
+            last_id = e.id
+            (c, data) = compress(e.body or b"", codec)
+            if c:
+                e.set(codec=c, body=data)
+                count += 1
+        commit()
+    return count
+
+def compact():
+    """
+    Rebuild the database file to reclaim the space freed by evicted entries.
+    """
+    with closing(sqlite3.connect(model.DB_FILE)) as conn:
+        conn.execute("VACUUM")
+
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description="Report on and maintain the streamglob response cache"
+    )
+    parser.add_argument("command", nargs="?", default="stats",
+                        choices=["stats", "compact"],
+                        help="stats: report cache size, "
+                        "compact: compress stored bodies and vacuum the database")
+    options = parser.parse_args()
+
+    config.load(merge_default=True)
+    model.init()
+
+    if options.command == "compact":
+        before = os.path.getsize(model.DB_FILE)
+        count = recompress()
+        compact()
+        after = os.path.getsize(model.DB_FILE)
+        print(f"compressed {count} entries, "
+              f"database {bitmath.Byte(before).best_prefix()} "
+              f"-> {bitmath.Byte(after).best_prefix()}")
+
+    s = stats()
+    print(f"entries:           {s.entries}")
+    print(f"body size:         {bitmath.Byte(s.size).best_prefix()}")
+    print(f"stored size:       {bitmath.Byte(s.stored).best_prefix()}")
+    print(f"compression ratio: "
+          f"{'%.2f' % s.ratio if s.ratio else '-'}")
+    print(f"database size:     {bitmath.Byte(s.file_size).best_prefix()}")
+
+
+if __name__ == "__main__":
+    main()
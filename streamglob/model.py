@@ -2,10 +2,14 @@ import logging
 logger = logging.getLogger(__name__)
 
 import os
+import sqlite3
+import asyncio
+from contextlib import closing
 from datetime import datetime, timedelta
 from dataclasses import *
 import typing
 import re
+import json
 import dataclasses_json
 from dataclasses_json import dataclass_json
 
@@ -22,6 +26,7 @@ dataclasses_json.mm.TYPES.update({
 
 from . import config
 from . import providers
+from .utils import parse_size
 from .exceptions import *
 
 DB_FILE=os.path.join(config.CONFIG_DIR, "streamglob.sqlite")
@@ -60,6 +65,176 @@ def upsert(cls, keys, values=None):
 
 db.Entity.upsert = classmethod(upsert)
 
+BULK_UPSERT_CHUNK_SIZE = 500
+
+def column_value(attr, value):
+    """
+    Convert a Python value to what Pony would store in the attribute's column.
+    """
+    if isinstance(value, db.Entity):
+        value = value._get_raw_pkval_()[0]
+    if value is None:
+        return None
+    converter = attr.converters[0]
+    return converter.py2sql(converter.val2dbval(value))
+
+def default_value(attr):
+    if attr.default is not None:
+        return attr.default() if callable(attr.default) else attr.default
+    if attr.is_required:
+        raise ValueError(f"{attr.name} is required")
+    if attr.py_type is str and not attr.nullable:
+        return ""
+    return None
+
+# INSERT ... ON CONFLICT ... RETURNING needs SQLite 3.35 or later, so older
+# versions upsert with separate statements
+SQLITE_HAS_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+@db_session
+def bulk_upsert(cls, keys, rows, chunk_size=BULK_UPSERT_CHUNK_SIZE):
+    """
+    Insert or update many rows at once, using one INSERT ... ON CONFLICT DO
+    UPDATE statement per chunk of rows.
+
+    :param cls: The entity class
+    :param keys: names of the attributes identifying a row, which must be
+        covered by a unique index or composite key
+    :param rows: dicts of attribute values, including the key attributes
+    :return: AttrDict with lists of `inserted` and `updated` primary keys
+
+    Only the values supplied in a row are overwritten when it matches an
+    existing one, as with upsert().  Objects already loaded in the current
+    db_session aren't refreshed.
+    """
+    result = AttrDict(inserted=[], updated=[])
+    rows = list(rows)
+    if not rows:
+        return result
+
+    table = cls._table_
+    pk = cls._pk_columns_[0]
+    key_attrs = [getattr(cls, k) for k in keys]
+    key_columns = ", ".join(f'"{a.column}"' for a in key_attrs)
+    attrs = [
+        a for a in cls._attrs_
+        if a.column and not a.is_pk and not a.is_discriminator
+    ]
+    columns = [a.column for a in attrs]
+    if cls._discriminator_attr_:
+        columns.append(cls._discriminator_attr_.column)
+    column_list = ", ".join(f'"{c}"' for c in columns)
+
+    def placeholders(n, offset):
+        return "(" + ", ".join(f"$(p[{offset+j}])" for j in range(n)) + ")"
+
+    def row_params(row):
+        params = [
+            column_value(
+                a, row[a.name] if a.name in row else default_value(a)
+            )
+            for a in attrs
+        ]
+        if cls._discriminator_attr_:
+            params.append(cls._discriminator_)
+        return params
+
+    def row_key(row):
+        return tuple(column_value(a, row[a.name]) for a in key_attrs)
+
+    def select_keys(chunk):
+        # map the key values of the chunk's existing rows to primary keys
+        params = [v for row in chunk for v in row_key(row)]
+        return dict(
+            (tuple(r[:-1]), r[-1])
+            for r in db.select(
+                f'SELECT {key_columns}, "{pk}" FROM "{table}" '
+                f"WHERE ({key_columns}) IN (VALUES "
+                + ", ".join(
+                    placeholders(len(key_attrs), n*len(key_attrs))
+                    for n in range(len(chunk))
+                ) + ")",
+                dict(p=params)
+            )
+        )
+
+    def insert_sql(chunk, conflict=""):
+        return (
+            f'INSERT INTO "{table}" ({column_list}) '
+            "VALUES " + ", ".join(
+                placeholders(len(columns), n*len(columns))
+                for n in range(len(chunk))
+            )
+            + conflict
+        )
+
+    # rows supplying different attributes need different updates, so each
+    # set of attributes gets its own statements
+    groups = dict()
+    for row in rows:
+        supplied = tuple(
+            a for a in attrs if a.name in row and a.name not in keys
+        )
+        groups.setdefault(supplied, []).append(row)
+
+    db.flush()
+    for supplied, group in groups.items():
+        for i in range(0, len(group), chunk_size):
+            chunk = group[i:i+chunk_size]
+            existing = select_keys(chunk)
+
+            if SQLITE_HAS_RETURNING:
+                if supplied:
+                    conflict = "DO UPDATE SET " + ", ".join(
+                        f'"{a.column}" = excluded."{a.column}"'
+                        for a in supplied
+                    )
+                else:
+                    conflict = "DO NOTHING"
+                sql = insert_sql(
+                    chunk,
+                    f" ON CONFLICT ({key_columns}) {conflict}"
+                    f' RETURNING "{pk}"'
+                )
+                params = [v for row in chunk for v in row_params(row)]
+                existing_pks = set(existing.values())
+                for (pkval,) in db.execute(sql, dict(p=params)).fetchall():
+                    if pkval in existing_pks:
+                        result.updated.append(pkval)
+                    else:
+                        result.inserted.append(pkval)
+                continue
+
+            new = []
+            for row in chunk:
+                pkval = existing.get(row_key(row))
+                if pkval is None:
+                    new.append(row)
+                    continue
+                if supplied:
+                    db.execute(
+                        f'UPDATE "{table}" SET '
+                        + ", ".join(
+                            f'"{a.column}" = $(p[{n}])'
+                            for n, a in enumerate(supplied)
+                        )
+                        + f' WHERE "{pk}" = $(p[{len(supplied)}])',
+                        dict(p=[
+                            column_value(a, row[a.name]) for a in supplied
+                        ] + [pkval])
+                    )
+                    result.updated.append(pkval)
+            if new:
+                db.execute(
+                    insert_sql(new),
+                    dict(p=[v for row in new for v in row_params(row)])
+                )
+                inserted = select_keys(new)
+                result.inserted += [inserted[row_key(row)] for row in new]
+    return result
+
+db.Entity.bulk_upsert = classmethod(bulk_upsert)
+
 
 @dataclass
 class BaseDataClass:
@@ -198,6 +373,41 @@ class MediaSource(BaseDataClass):
     def locator(self):
         return self.url
 
+    @classmethod
+    def field_names(cls):
+        names = cls.__dict__.get("_field_names")
+        if names is None:
+            names = cls._field_names = [f.name for f in fields(cls)]
+        return names
+
+    @classmethod
+    def to_content(cls, sources):
+        """
+        Encode a list of media sources for MediaItem.content as plain dicts,
+        without going through a marshmallow schema.  Missing sources (None)
+        are skipped.
+        """
+        return [
+            {name: getattr(s, name) for name in s.field_names()}
+            for s in sources
+            if s is not None
+        ]
+
+    @classmethod
+    def from_content(cls, content):
+        """
+        Decode MediaItem.content into a list of media sources by constructing
+        the dataclasses directly, which is much faster than schema().loads()
+        """
+        if isinstance(content, str):
+            # stored before content was kept as plain dicts
+            content = json.loads(content)
+        names = cls.field_names()
+        return [
+            cls(**{k: v for k, v in source.items() if k in names})
+            for source in content
+        ]
+
     # def __str__(self):
     #     return self.locator
 
@@ -232,18 +442,26 @@ class DownloadMediaTask(ProgramMediaTask):
     dest: typing.Optional[str] = None
 
 class CacheEntry(db.Entity):
+    """
+    A cached HTTP response.  The body, status and a subset of the response
+    headers are stored separately so that entries can be revalidated with the
+    origin server using the ETag / Last-Modified validators.
+    """
 
-    url = Required(str, unique=True)
-    response = Required(bytes)
-    last_seen = Required(datetime, default=datetime.now)
-
-    @classmethod
-    @db_session
-    def purge(cls, age=CACHE_DURATION_LONG):
-
-        cls.select(
-            lambda e: e.last_seen < datetime.now() - timedelta(seconds=age)
-        ).delete()
+    key = Required(str, unique=True)
+    url = Required(str)
+    status = Required(int)
+    headers = Required(Json)
+    body = Optional(bytes)
+    # compression used for the body ("" for none) and its uncompressed size
+    codec = Optional(str)
+    size = Required(int, default=0)
+    etag = Optional(str)
+    last_modified = Optional(str)
+    last_seen = Required(datetime, default=datetime.now, index=True)
+    # set for entries that are still usable (e.g. stale-while-revalidate)
+    # after the cache evictor's max_age
+    keep_until = Optional(datetime)
 
 class MediaChannel(db.Entity):
     """
@@ -286,20 +504,102 @@ class MediaFeed(MediaChannel):
     DEFAULT_MIN_ITEMS=10
     DEFAULT_MAX_ITEMS=500
     DEFAULT_MAX_AGE=90
+    GUID_BATCH_SIZE=500
 
     items = Set(lambda: MediaItem)
+    archived_items = Set(lambda: MediaItemArchive)
+
+    @db_session
+    def existing_guids(self, guids):
+        """
+        Return the subset of `guids` already belonging to items in this feed or
+        its archive, looked up with one query per batch rather than one per
+        item.
+        """
+        guids = list(guids)
+        existing = set()
+        for n in range(0, len(guids), self.GUID_BATCH_SIZE):
+            batch = guids[n:n+self.GUID_BATCH_SIZE]
+            existing.update(
+                select(
+                    i.guid for i in MediaItem
+                    if i.feed == self and i.guid in batch
+                )[:]
+            )
+        return existing | self.archived_guids(guids)
+
+    @db_session
+    def archived_guids(self, guids):
+        """
+        Return the subset of `guids` belonging to items purged from this feed.
+        """
+        guids = list(guids)
+        archived = set()
+        for n in range(0, len(guids), self.GUID_BATCH_SIZE):
+            batch = guids[n:n+self.GUID_BATCH_SIZE]
+            archived.update(
+                select(
+                    a.guid for a in MediaItemArchive
+                    if a.feed == self and a.guid in batch
+                )[:]
+            )
+        return archived
+
+    def fetch(self, limit=None):
+        """
+        Fetch the feed's latest entries, yielding a dict of item attributes
+        (including the guid) for each one.  This only reads from the database,
+        so it can run on any thread.  Entries already in the feed may be
+        skipped here to save work, but ingest() checks again.
+        """
+        raise NotImplementedError
+
+    @db_session
+    def ingest(self, rows):
+        """
+        Store fetched entries that aren't already in the feed and mark the feed
+        as updated.  Returns the ids of the new items.
+        """
+        rows = dict((row["guid"], row) for row in rows)
+        existing = self.existing_guids(rows.keys())
+        items = [
+            self.ITEM_CLASS(feed=self, **row)
+            for guid, row in rows.items()
+            if guid not in existing
+        ]
+        self.updated = datetime.now()
+        flush()
+        return [i.media_item_id for i in items]
 
     @db_session
-    def mark_all_items_read(self):
-        for i in self.items.select():
-            i.read = datetime.now()
+    def mark_all_items_read(self, read=None):
+        return self.mark_items_read([self.channel_id], read)
 
     @classmethod
     @db_session
-    def mark_all_feeds_read(cls):
-        for f in cls.select():
-            for i in f.items.select():
-                i.read = datetime.now()
+    def mark_all_feeds_read(cls, read=None):
+        return cls.mark_items_read(select(f.channel_id for f in cls)[:], read)
+
+    @classmethod
+    @db_session
+    def mark_items_read(cls, feed_ids, read=None):
+        """
+        Mark every unread item in the given feeds as read with a single UPDATE.
+        Returns the number of items changed.
+        """
+        if not feed_ids:
+            return 0
+        p = [column_value(MediaItem.read, read or datetime.now())] + list(feed_ids)
+        feeds = ", ".join(f"$(p[{n}])" for n in range(1, len(p)))
+        db.flush()
+        cursor = db.execute(
+            f"""
+            UPDATE MediaItem SET read = $(p[0])
+            WHERE read IS NULL AND feed IN ({feeds})
+            """,
+            dict(p=p)
+        )
+        return cursor.rowcount
 
     @classmethod
     @db_session
@@ -307,10 +607,12 @@ class MediaFeed(MediaChannel):
                   min_items = DEFAULT_MIN_ITEMS,
                   max_items = DEFAULT_MAX_ITEMS,
                   max_age = DEFAULT_MAX_AGE):
-        for f in cls.select():
-            f.purge(min_items = min_items,
-                    max_items = max_items,
-                    max_age = max_age)
+        """
+        Purge every feed of this class with a single statement.  Returns the
+        number of items deleted.
+        """
+        feed_ids = select(f.channel_id for f in cls)[:]
+        return cls.purge_items(feed_ids, min_items, max_items, max_age)
 
     @db_session
     def purge(self,
@@ -319,18 +621,63 @@ class MediaFeed(MediaChannel):
               max_age = DEFAULT_MAX_AGE):
         """
         Delete items older than "max_age" days, keeping no fewer than
-        "min_items" and no more than "max_items"
+        "min_items" and no more than "max_items".  Returns the number of items
+        deleted.
         """
-        for n, i in enumerate(
-                self.items.select().order_by(
-                    lambda i: desc(i.created)
-                )[min_items:]
-        ):
-            if (min_items + n >= max_items
-                or
-                i.age >= timedelta(days=max_age)):
-                i.delete()
-        commit()
+        return self.purge_items([self.channel_id], min_items, max_items, max_age)
+
+    @classmethod
+    @db_session
+    def purge_items(cls, feed_ids, min_items, max_items, max_age, archive=True):
+        """
+        Delete the items of the given feeds that fall outside the limits, ranking
+        each feed's items newest first with a window function so the whole
+        purge is one DELETE.  Unless `archive` is False, the purged items are
+        first copied to MediaItemArchive so that they won't come back as new
+        the next time they're seen in the feed.
+        """
+        if not feed_ids:
+            return 0
+        p = [
+            column_value(MediaItem.created,
+                         datetime.now() - timedelta(days=max_age)),
+            min_items,
+            max_items,
+        ] + list(feed_ids)
+        feeds = ", ".join(f"$(p[{n}])" for n in range(3, len(p)))
+        purged = f"""
+            SELECT media_item_id FROM (
+                SELECT media_item_id, created, ROW_NUMBER() OVER (
+                    PARTITION BY feed
+                    ORDER BY created DESC, media_item_id DESC
+                ) AS rank
+                FROM MediaItem
+                WHERE feed IN ({feeds})
+            )
+            WHERE rank > $(p[1])
+            AND (rank > $(p[2]) OR created <= $(p[0]))
+        """
+        db.flush()
+        if archive:
+            db.execute(
+                f"""
+                INSERT INTO MediaItemArchive
+                    (feed, guid, title, created, watched, downloaded)
+                SELECT feed, guid, title, created, watched, downloaded
+                FROM MediaItem WHERE media_item_id IN ({purged})
+                ON CONFLICT (feed, guid) DO UPDATE SET
+                    title = excluded.title,
+                    created = excluded.created,
+                    watched = coalesce(excluded.watched, watched),
+                    downloaded = coalesce(excluded.downloaded, downloaded)
+                """,
+                dict(p=p)
+            )
+        cursor = db.execute(
+            f"DELETE FROM MediaItem WHERE media_item_id IN ({purged})",
+            dict(p=p)
+        )
+        return cursor.rowcount
 
 
 class MediaItem(db.Entity):
@@ -343,21 +690,66 @@ class MediaItem(db.Entity):
     feed = Required(lambda: MediaFeed)
     guid = Required(str, index=True)
     title = Required(str)
+    description = Optional(str)
     content = Required(Json)
-    created = Required(datetime, default=datetime.now)
+    created = Required(datetime, default=datetime.now, index=True)
     read = Optional(datetime)
     watched = Optional(datetime)
     downloaded = Optional(datetime)
     # was_downloaded = Required(bool, default=False)
+    composite_key(feed, guid)
+    composite_index(feed, created)
+    composite_index(feed, read)
+    composite_index(feed, downloaded)
 
     @db_session
-    def mark_read(self):
-        self.read = datetime.now()
+    def mark_read(self, read=None):
+        self.read = read or datetime.now()
 
     @db_session
     def mark_unread(self):
         self.read = None
 
+    @classmethod
+    @db_session
+    def set_read_states(cls, states):
+        """
+        Apply a dict of item ids to read times (None for unread) in one
+        transaction.  Items that have since been purged are skipped.
+        """
+        ids = list(states.keys())
+        for item in cls.select(lambda i: i.media_item_id in ids):
+            item.read = states[item.media_item_id]
+
+    @classmethod
+    def seek(cls, query, sort_field, sort_desc, cursor):
+        """
+        Restrict a query ordered by `sort_field` and then media_item_id to the
+        rows after `cursor`, the MediaListing of the last row already loaded.
+        Returns None if the cursor isn't a listing with both values.
+        """
+        if not isinstance(cursor, MediaListing):
+            return None
+        value = cursor.get(sort_field)
+        last_id = cursor.get("media_item_id")
+        if value is None or last_id is None:
+            return None
+
+        # the redundant first comparison lets SQLite seek straight to the
+        # cursor in the sort column's index instead of scanning up to it
+        if sort_desc:
+            return query.filter(
+                lambda i: getattr(i, sort_field) <= value
+                and (getattr(i, sort_field) < value
+                     or i.media_item_id < last_id)
+            )
+        else:
+            return query.filter(
+                lambda i: getattr(i, sort_field) >= value
+                and (getattr(i, sort_field) > value
+                     or i.media_item_id > last_id)
+            )
+
     def created_date(self):
         return datetime.now().strftime("%Y%m%d_%H%M%S")
 
@@ -375,6 +767,53 @@ class MediaItem(db.Entity):
     #     return d
 
 
+class MediaItemArchive(db.Entity):
+    """
+    What's kept of items purged from a feed: enough to recognize them if they
+    show up in the feed again, and to remember whether they were watched or
+    downloaded.
+    """
+
+    feed = Required(lambda: MediaFeed)
+    guid = Required(str)
+    title = Required(str)
+    created = Required(datetime)
+    watched = Optional(datetime)
+    downloaded = Optional(datetime)
+    PrimaryKey(feed, guid)
+
+
+class MediaFeedCounts(db.Entity):
+    """
+    Item counts for each feed, kept up to date by triggers on MediaItem (see
+    setup_feed_counts) so that they change in the same transaction as the
+    items themselves, however the items are written.
+    """
+
+    feed = PrimaryKey(int)
+    total = Required(int, default=0)
+    unread = Required(int, default=0)
+    not_downloaded = Required(int, default=0)
+
+    STATUSES = {
+        "all": "total",
+        "unread": "unread",
+        "not_downloaded": "not_downloaded"
+    }
+
+    @classmethod
+    @db_session
+    def count(cls, feed_ids, status="all"):
+        """
+        Return the number of items with the given status in the given feeds.
+        """
+        column = cls.STATUSES[status]
+        return sum(
+            getattr(c, column)
+            for c in cls.select(lambda c: c.feed in feed_ids)
+        )
+
+
 class ProviderData(db.Entity):
     # Providers inherit from this to define their own fields
     classtype = Discriminator(str)
@@ -382,22 +821,401 @@ class ProviderData(db.Entity):
 
 
 
-def init(*args, **kwargs):
+def table_columns(conn, table):
+    return [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+
+def drop_pickled_cache(conn):
+    # CacheEntry used to hold whole pickled requests.Response objects, which
+    # can't be converted, so just start over with an empty cache.
+    if "response" in table_columns(conn, "CacheEntry"):
+        logger.info("dropping legacy response cache")
+        conn.execute("DROP TABLE CacheEntry")
 
+def add_column(conn, table, column, decl):
+    columns = table_columns(conn, table)
+    if columns and column not in columns:
+        logger.info(f"adding column {table}.{column}")
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+        return True
+    return False
+
+def add_cache_codec(conn):
+    add_column(conn, "CacheEntry", "codec", "TEXT NOT NULL DEFAULT ''")
+    if add_column(conn, "CacheEntry", "size", "INTEGER NOT NULL DEFAULT 0"):
+        conn.execute("UPDATE CacheEntry SET size = length(body)")
+
+def add_cache_keep_until(conn):
+    add_column(conn, "CacheEntry", "keep_until", "DATETIME")
+
+def add_item_description(conn):
+    add_column(conn, "MediaItem", "description", "TEXT NOT NULL DEFAULT ''")
+
+def unwrap_item_content(conn):
+    # MediaItem.content used to hold a JSON string containing the media
+    # sources' JSON, which had to be parsed twice
+    if not table_columns(conn, "MediaItem"):
+        return
+    cursor = conn.execute(
+        "UPDATE MediaItem SET content = json(json_extract(content, '$'))"
+        " WHERE json_type(content) = 'text'"
+    )
+    if cursor.rowcount:
+        logger.info(f"unwrapped content of {cursor.rowcount} items")
+
+def add_item_guid_key(conn):
+    # bulk upserts need a unique (feed, guid) index to detect conflicts on.
+    # New databases get it from MediaItem's composite key.
+    if not table_columns(conn, "MediaItem"):
+        return
+    if conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'index'"
+            " AND name = 'unq_mediaitem__feed_guid'"
+    ).fetchone():
+        return
+    if conn.execute(
+            "SELECT sql FROM sqlite_master WHERE name = 'MediaItem'"
+    ).fetchone()[0].find("unq_mediaitem__feed_guid") >= 0:
+        return
+    logger.info("adding unique key on MediaItem (feed, guid)")
+    conn.execute(
+        "DELETE FROM MediaItem WHERE media_item_id NOT IN"
+        " (SELECT min(media_item_id) FROM MediaItem GROUP BY feed, guid)"
+    )
+    conn.execute(
+        'CREATE UNIQUE INDEX "unq_mediaitem__feed_guid"'
+        ' ON "MediaItem" ("feed", "guid")'
+    )
+
+MIGRATIONS = [
+    drop_pickled_cache,
+    add_cache_codec,
+    add_item_guid_key,
+    unwrap_item_content,
+    add_item_description,
+    add_cache_keep_until,
+]
+
+def migrate():
+    """
+    Bring an existing database up to date with changes that Pony won't make on
+    its own when generating the mapping (dropped or added columns, new
+    constraints, etc.)  Each migration checks the current schema first, so it's
+    safe to run them all on every startup.
+    """
+    if not os.path.exists(DB_FILE):
+        return
+    with closing(sqlite3.connect(DB_FILE)) as conn:
+        with conn:
+            for migration in MIGRATIONS:
+                migration(conn)
+
+# The queries behind browsing, counting and purging a feed, which should all
+# be answered from MediaItem's indexes rather than by scanning the table.
+QUERY_PLAN_CHECKS = [
+    "SELECT * FROM MediaItem WHERE feed = ? ORDER BY created DESC LIMIT 100",
+    "SELECT * FROM MediaItem WHERE feed = ? AND read IS NULL"
+    " ORDER BY created DESC LIMIT 100",
+    "SELECT count(*) FROM MediaItem WHERE feed = ?",
+    "SELECT count(*) FROM MediaItem WHERE feed = ? AND read IS NULL",
+    "SELECT count(*) FROM MediaItem WHERE feed = ? AND downloaded IS NULL",
+    "SELECT media_item_id FROM MediaItem WHERE feed = ? AND guid = ?",
+    "SELECT guid FROM MediaItemArchive WHERE feed = ? AND guid IN (?, ?)",
+    "SELECT media_item_id FROM MediaItem WHERE feed = ? AND created < ?",
+    "SELECT * FROM MediaItem WHERE feed = ? AND created <= ?"
+    " AND (created < ? OR media_item_id < ?)"
+    " ORDER BY created DESC, media_item_id DESC LIMIT 100",
+    "SELECT * FROM MediaItem WHERE created <= ?"
+    " AND (created < ? OR media_item_id < ?)"
+    " ORDER BY created DESC, media_item_id DESC LIMIT 100",
+]
+
+def query_plan(conn, sql):
+    return [
+        row[-1] for row in conn.execute(
+            f"EXPLAIN QUERY PLAN {sql}", [None] * sql.count("?")
+        )
+    ]
+
+def check_query_plans():
+    """
+    Run EXPLAIN QUERY PLAN on the main feed queries, and warn about any that
+    still need a full table scan or a temporary sort.  Returns a list of
+    (query, plan) tuples for the queries with a problem.
+    """
+    problems = []
+    with closing(sqlite3.connect(DB_FILE)) as conn:
+        for sql in QUERY_PLAN_CHECKS:
+            plan = query_plan(conn, sql)
+            if any(
+                    step.startswith("SCAN") or "TEMP B-TREE" in step
+                    for step in plan
+            ):
+                logger.warning(f"inefficient query plan for {sql}: {plan}")
+                problems.append((sql, plan))
+    return problems
+
+# Applied to every connection to the database.  WAL lets the UI read while
+# feed updates are being written, and synchronous=NORMAL is safe with WAL.
+SQLITE_PRAGMAS = AttrDict(
+    journal_mode = "wal",
+    synchronous = "normal",
+    mmap_size = "256MiB",
+    cache_size = "64MiB",
+    temp_store = "memory",
+    busy_timeout = 5000,
+)
+
+# Sizes given for these are converted to bytes, or to kibibytes for cache_size,
+# which takes a negative number to mean a size rather than a page count
+SQLITE_SIZE_PRAGMAS = {"mmap_size": 1, "cache_size": -1024}
+
+MAINTENANCE_INTERVAL = 3600
+
+# rows sampled per index by ANALYZE during maintenance
+ANALYSIS_LIMIT = 400
+
+def configure_sqlite(settings=None):
+    """
+    Merge the `pragmas` section of the profile's `database` settings into the
+    defaults above.
+    """
+    global MAINTENANCE_INTERVAL
+    settings = settings or {}
+    for name, value in (settings.get("pragmas") or {}).items():
+        SQLITE_PRAGMAS[name] = value
+    MAINTENANCE_INTERVAL = settings.get(
+        "maintenance_interval", MAINTENANCE_INTERVAL
+    )
+
+def pragma_value(name, value):
+    if name in SQLITE_SIZE_PRAGMAS and isinstance(value, str):
+        scale = SQLITE_SIZE_PRAGMAS[name]
+        if scale < 0:
+            return parse_size(value) // scale
+        return parse_size(value) * scale
+    return value
+
+@db.on_connect(provider="sqlite")
+def apply_pragmas(db, connection):
+    cursor = connection.cursor()
+    for name, value in SQLITE_PRAGMAS.items():
+        if value is None:
+            continue
+        cursor.execute(f"PRAGMA {name} = {pragma_value(name, value)}")
+
+def maintain():
+    """
+    Checkpoint the write-ahead log so it doesn't grow without bound, and
+    refresh the query planner's statistics.
+    """
+    start = datetime.now()
+    with closing(sqlite3.connect(DB_FILE)) as conn:
+        (busy, log, checkpointed) = conn.execute(
+            "PRAGMA wal_checkpoint(PASSIVE)"
+        ).fetchone()
+        conn.execute(f"PRAGMA analysis_limit = {ANALYSIS_LIMIT}")
+        conn.execute("ANALYZE")
+        conn.commit()
+    logger.info(f"database maintenance: checkpointed {checkpointed}/{log} "
+                f"WAL frames in {datetime.now() - start}")
+
+async def run_maintenance():
+    loop = asyncio.get_event_loop()
+    while True:
+        await asyncio.sleep(MAINTENANCE_INTERVAL)
+        try:
+            await loop.run_in_executor(None, maintain)
+        except sqlite3.Error as e:
+            logger.warning(f"database maintenance failed: {e}")
+
+FEED_COUNTS_TRIGGERS = {
+    "feed_counts_insert": """
+        CREATE TRIGGER feed_counts_insert AFTER INSERT ON MediaItem BEGIN
+            INSERT INTO MediaFeedCounts (feed, total, unread, not_downloaded)
+            VALUES (
+                NEW.feed, 1, NEW.read IS NULL, NEW.downloaded IS NULL
+            )
+            ON CONFLICT (feed) DO UPDATE SET
+                total = total + 1,
+                unread = unread + excluded.unread,
+                not_downloaded = not_downloaded + excluded.not_downloaded;
+        END
+    """,
+    "feed_counts_delete": """
+        CREATE TRIGGER feed_counts_delete AFTER DELETE ON MediaItem BEGIN
+            UPDATE MediaFeedCounts SET
+                total = total - 1,
+                unread = unread - (OLD.read IS NULL),
+                not_downloaded = not_downloaded - (OLD.downloaded IS NULL)
+            WHERE feed = OLD.feed;
+        END
+    """,
+    "feed_counts_update": """
+        CREATE TRIGGER feed_counts_update
+        AFTER UPDATE OF feed, read, downloaded ON MediaItem BEGIN
+            UPDATE MediaFeedCounts SET
+                total = total - 1,
+                unread = unread - (OLD.read IS NULL),
+                not_downloaded = not_downloaded - (OLD.downloaded IS NULL)
+            WHERE feed = OLD.feed;
+            INSERT INTO MediaFeedCounts (feed, total, unread, not_downloaded)
+            VALUES (
+                NEW.feed, 1, NEW.read IS NULL, NEW.downloaded IS NULL
+            )
+            ON CONFLICT (feed) DO UPDATE SET
+                total = total + 1,
+                unread = unread + excluded.unread,
+                not_downloaded = not_downloaded + excluded.not_downloaded;
+        END
+    """,
+    "feed_counts_feed_delete": """
+        CREATE TRIGGER feed_counts_feed_delete AFTER DELETE ON MediaChannel BEGIN
+            DELETE FROM MediaFeedCounts WHERE feed = OLD.channel_id;
+        END
+    """,
+}
+
+def setup_feed_counts(conn):
+    existing = set(
+        row[0] for row in conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'trigger'"
+        )
+    )
+    missing = [name for name in FEED_COUNTS_TRIGGERS if name not in existing]
+    if not missing:
+        return
+    for name in missing:
+        conn.execute(FEED_COUNTS_TRIGGERS[name])
+    # the counts can't be trusted without all of the triggers, so start over
+    logger.info("rebuilding feed counts")
+    conn.execute("DELETE FROM MediaFeedCounts")
+    conn.execute("""
+        INSERT INTO MediaFeedCounts (feed, total, unread, not_downloaded)
+        SELECT feed, count(*), sum(read IS NULL), sum(downloaded IS NULL)
+        FROM MediaItem GROUP BY feed
+    """)
+
+# Full text index of item titles and descriptions.  It's an external content
+# table, so it stores only the index and reads the text back from MediaItem.
+ITEM_SEARCH_TABLE = "MediaItemSearch"
+
+# whether this SQLite was built with FTS5; set by setup_item_search
+ITEM_SEARCH_AVAILABLE = False
+
+# titles are short, so a match there counts for more than one in a description
+ITEM_SEARCH_WEIGHTS = (10.0, 1.0)
+
+ITEM_SEARCH_TRIGGERS = {
+    "item_search_insert": f"""
+        CREATE TRIGGER item_search_insert AFTER INSERT ON MediaItem BEGIN
+            INSERT INTO {ITEM_SEARCH_TABLE} (rowid, title, description)
+            VALUES (NEW.media_item_id, NEW.title, NEW.description);
+        END
+    """,
+    "item_search_delete": f"""
+        CREATE TRIGGER item_search_delete AFTER DELETE ON MediaItem BEGIN
+            INSERT INTO {ITEM_SEARCH_TABLE}
+                ({ITEM_SEARCH_TABLE}, rowid, title, description)
+            VALUES ('delete', OLD.media_item_id, OLD.title, OLD.description);
+        END
+    """,
+    "item_search_update": f"""
+        CREATE TRIGGER item_search_update
+        AFTER UPDATE OF title, description ON MediaItem BEGIN
+            INSERT INTO {ITEM_SEARCH_TABLE}
+                ({ITEM_SEARCH_TABLE}, rowid, title, description)
+            VALUES ('delete', OLD.media_item_id, OLD.title, OLD.description);
+            INSERT INTO {ITEM_SEARCH_TABLE} (rowid, title, description)
+            VALUES (NEW.media_item_id, NEW.title, NEW.description);
+        END
+    """,
+}
+
+def setup_item_search(conn):
+    global ITEM_SEARCH_AVAILABLE
+    rebuild = False
+    if not conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = ?", (ITEM_SEARCH_TABLE,)
+    ).fetchone():
+        try:
+            conn.execute(f"""
+                CREATE VIRTUAL TABLE {ITEM_SEARCH_TABLE} USING fts5(
+                    title, description,
+                    content = 'MediaItem', content_rowid = 'media_item_id',
+                    tokenize = 'unicode61 remove_diacritics 2',
+                    prefix = '2 3'
+                )
+            """)
+        except sqlite3.OperationalError as e:
+            logger.warning(f"item search unavailable: {e}")
+            return
+        rebuild = True
+    existing = set(
+        row[0] for row in conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'trigger'"
+        )
+    )
+    for name, sql in ITEM_SEARCH_TRIGGERS.items():
+        if name not in existing:
+            conn.execute(sql)
+            rebuild = True
+    if rebuild:
+        logger.info("rebuilding item search index")
+        conn.execute(
+            f"INSERT INTO {ITEM_SEARCH_TABLE} ({ITEM_SEARCH_TABLE})"
+            " VALUES ('rebuild')"
+        )
+    ITEM_SEARCH_AVAILABLE = True
+
+def item_search_query(text):
+    """
+    Turn text typed into a search box into an FTS5 query matching items that
+    contain every word, treating the last word as a prefix so that results
+    show up while it's still being typed.  Returns None if there's nothing to
+    search for.
+    """
+    terms = [
+        '"' + term.replace('"', '""') + '"'
+        for term in (text or "").split()
+    ]
+    if not terms:
+        return None
+    terms[-1] += "*"
+    return " ".join(terms)
+
+# Schema objects Pony doesn't manage (triggers, virtual tables), set up once
+# the mapping has created the tables they depend on.
+SCHEMA_SETUP = [
+    setup_feed_counts,
+    setup_item_search,
+]
+
+def setup_schema():
+    with closing(sqlite3.connect(DB_FILE)) as conn:
+        with conn:
+            for setup in SCHEMA_SETUP:
+                setup(conn)
+
+def init(settings=None, *args, **kwargs):
+
+    configure_sqlite(settings)
+    migrate()
     db.bind("sqlite", create_db=True, filename=DB_FILE, *args, **kwargs)
     db.generate_mapping(create_tables=True)
-    CacheEntry.purge()
+    setup_schema()
+    check_query_plans()
 
 def main():
 
-    init()
     config.load(merge_default=True)
+    init(config.settings.profile.get("database"))
 
-    MediaFeed.purge_all(
+    count = MediaFeed.purge_all(
         min_items = config.settings.profile.cache.min_items,
         max_items = config.settings.profile.cache.max_items,
         max_age = config.settings.profile.cache.max_age
     )
+    logger.info(f"purged {count} items")
 
 
 if __name__ == "__main__":
@@ -1608,11 +1608,16 @@ class BAMProviderMixin(BackgroundTasksMixin, abc.ABC):
         )
 
     async def update(self):
-        self.update_games()
-
-    def update_games(self):
         date = self.filters.date.value
-        schedule = self.schedule(start=date, end=date)
+        response = await self.session.aget(
+            self.schedule_url(start=date, end=date)
+        )
+        self.update_games(response.json())
+
+    def update_games(self, schedule=None):
+        if schedule is None:
+            date = self.filters.date.value
+            schedule = self.schedule(start=date, end=date)
         try:
             games = schedule["dates"][-1]["games"]
         except IndexError:
@@ -1624,7 +1629,7 @@ class BAMProviderMixin(BackgroundTasksMixin, abc.ABC):
         self.view.table.refresh()
 
     def on_date_change(self, date):
-        self.update_games()
+        state.asyncio_loop.create_task(self.update())
 
     def on_hide_spoilers_change(self, value):
         self.reset()
@@ -1647,8 +1652,7 @@ class BAMProviderMixin(BackgroundTasksMixin, abc.ABC):
         # return game
 
 
-    @memo(region="short")
-    def schedule(
+    def schedule_url(
             self,
             # sport_id=None,
             season=None, # season only works for NHL
@@ -1686,9 +1690,36 @@ class BAMProviderMixin(BackgroundTasksMixin, abc.ABC):
             game_id = game_id if game_id else ""
         )
         logger.debug(url)
+        return url
+
+    @memo(region="short")
+    def schedule(
+            self,
+            season=None,
+            start=None,
+            end=None,
+            game_type=None,
+            team_id=None,
+            game_id=None,
+            brief=False
+    ):
+
+        url = self.schedule_url(
+            season=season,
+            start=start,
+            end=end,
+            game_type=game_type,
+            team_id=team_id,
+            game_id=game_id,
+            brief=brief
+        )
 
-        # with self.cache_responses_short():
-        return self.session.get(url).json()
+        # schedule data a few minutes old is fine for browsing, and the
+        # listing is refreshed by update() when anything changes
+        with self.session.cache_responses_short(
+                stale_while_revalidate=model.CACHE_DURATION_SHORT*5
+        ):
+            return self.session.get(url).json()
 
 
     def listings(self, offset=None, limit=None, *args, **kwargs):
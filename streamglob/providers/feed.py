@@ -1,12 +1,17 @@
 from datetime import datetime
 from dataclasses import *
 import typing
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 
 from orderedattrdict import AttrDict
 from panwid.dialog import *
+from pony.orm.core import Attribute
 
 from .. import model
 from .. import utils
+from .. import writer
 
 from .base import *
 
@@ -47,6 +52,8 @@ class CachedFeedProviderDataTable(ProviderDataTable):
     signals = ["focus"]
 
     HOVER_DELAY = 0.25
+    # how often buffered read / unread changes are written
+    READ_FLUSH_INTERVAL = 0.3
 
     with_scrollbar=True
     sort_by = ("created", True)
@@ -54,6 +61,9 @@ class CachedFeedProviderDataTable(ProviderDataTable):
     no_load_on_init = True
 
     def __init__(self, *args, **kwargs):
+        self.pending_read_states = dict()
+        self.read_flush_task = None
+        self.read_flush_result = None
         super().__init__(*args, **kwargs)
         self.ignore_blur = False
         self.mark_read_task = None
@@ -63,13 +73,25 @@ class CachedFeedProviderDataTable(ProviderDataTable):
             self.on_focus
         )
 
+    def query_cursor(self, offset):
+        # rows are being appended after the last one loaded, so the query can
+        # continue from it rather than counting through an offset
+        if not offset or offset != len(self):
+            return None
+        data = self[offset-1].data
+        if not isinstance(data, model.MediaListing):
+            return None
+        return data
+
     def query_result_count(self):
         if self.update_count:
             with db_session:
                 if not self.provider.items_query:
                     return 0
                 # self._row_count = len(self.provider.feed.items)
-                self._row_count = self.provider.items_query.count()
+                self._row_count = self.provider.item_count()
+                if self._row_count is None:
+                    self._row_count = self.provider.items_query.count()
                 logger.info(f"row count: {self._row_count}")
                 self.update_count = False
         return self._row_count
@@ -80,7 +102,6 @@ class CachedFeedProviderDataTable(ProviderDataTable):
             return "unread"
         return None
 
-    @db_session
     def on_focus(self, source, position):
         if self.mark_read_task:
             self.mark_read_task.cancel()
@@ -89,41 +110,90 @@ class CachedFeedProviderDataTable(ProviderDataTable):
             lambda: self.mark_item_read(position)
         )
 
-    @db_session
     def on_blur(self, source, position):
         if self.ignore_blur:
             self.ignore_blur = False
             return
         self.mark_item_read(position)
 
-    @db_session
     def mark_item_read(self, position):
         try:
             if not isinstance(self[position].data, model.MediaListing):
                 return
         except IndexError:
             return
-        item = self.item_at_position(position)
-        if not item:
+        media_item_id = self[position].data.media_item_id
+        if media_item_id is None:
             return
-        item.mark_read()
+        read = datetime.now()
+        self.buffer_read_state(media_item_id, read)
         self[position].clear_attr("unread")
-        self.set_value(position, "read", item.read)
-        self.invalidate_rows([self[position].data.media_item_id])
+        self.set_value(position, "read", read)
+        self.invalidate_rows([media_item_id])
 
-    @db_session
     def mark_item_unread(self, position):
         if not isinstance(self[position].data, MediaListing):
             return
-        item = self.item_at_position(position)
-        if not item:
+        media_item_id = self[position].data.media_item_id
+        if media_item_id is None:
             return
-        item.mark_unread()
+        self.buffer_read_state(media_item_id, None)
         self[position].set_attr("unread")
-        self.set_value(position, "read", item.read)
-        self.invalidate_rows([self[position].data.media_item_id])
+        self.set_value(position, "read", None)
+        self.invalidate_rows([media_item_id])
+
+    def buffer_read_state(self, media_item_id, read):
+        # rows are marked as they're scrolled past, so rather than commit each
+        # one, collect them and write whatever has accumulated periodically
+        self.pending_read_states[media_item_id] = read
+        if not self.read_flush_task:
+            self.read_flush_task = state.asyncio_loop.call_later(
+                self.READ_FLUSH_INTERVAL,
+                self.flush_read_states
+            )
+
+    def flush_read_states(self):
+        """
+        Queue buffered read / unread changes to be written to the database in
+        one transaction.
+        """
+        if self.read_flush_task:
+            self.read_flush_task.cancel()
+            self.read_flush_task = None
+        if not self.pending_read_states:
+            return
+        states = self.pending_read_states
+        self.pending_read_states = dict()
+        item_class = self.provider.ITEM_CLASS
+        self.read_flush_result = writer.db_writer.submit(
+            lambda: item_class.set_read_states(states)
+        )
+
+    def after_read_states(self, fn, *args, **kwargs):
+        """
+        Call fn(*args, **kwargs) on the event loop once every read / unread
+        change so far has been committed, without blocking until then.
+        """
+        self.flush_read_states()
+        result = self.read_flush_result
+        if not result or result.done():
+            return fn(*args, **kwargs)
+        # the writer commits in order, so the last flush covers the others
+        result.add_done_callback(
+            lambda f: state.asyncio_loop.call_soon_threadsafe(
+                lambda: fn(*args, **kwargs)
+            )
+        )
+
+    # rows are about to be reloaded in these, so hold off until they'll see
+    # any changes that haven't been written yet
+
+    def refresh(self, *args, **kwargs):
+        self.after_read_states(super().refresh, *args, **kwargs)
+
+    def reset(self, *args, **kwargs):
+        self.after_read_states(super().reset, *args, **kwargs)
 
-    @db_session
     def toggle_item_read(self, position):
         if not isinstance(self[position].data, MediaListing):
             return
@@ -133,6 +203,43 @@ class CachedFeedProviderDataTable(ProviderDataTable):
         else:
             self.mark_item_read(position)
 
+    def mark_all_read(self):
+        # write anything buffered first so it can't undo this afterward
+        self.flush_read_states()
+        read = datetime.now()
+        feed = self.provider.feed
+        feed_class = self.provider.FEED_CLASS
+        if feed:
+            feed_id = feed.channel_id
+            result = writer.db_writer.submit(
+                lambda: feed_class[feed_id].mark_all_items_read(read)
+            )
+        else:
+            result = writer.db_writer.submit(
+                lambda: feed_class.mark_all_feeds_read(read)
+            )
+
+        if self.provider.filters.status.value == "unread":
+            # nothing left to show once the update has been written
+            def reset(f):
+                self.update_count = True
+                state.asyncio_loop.call_soon_threadsafe(self.reset)
+            result.add_done_callback(reset)
+            return
+
+        # the row count hasn't changed, so just update the rows in place
+        positions = [
+            position for position in range(len(self))
+            if isinstance(self[position].data, model.MediaListing)
+            and not self[position].data.get("read")
+        ]
+        for position in positions:
+            self[position].clear_attr("unread")
+            self.set_value(position, "read", read)
+        self.invalidate_rows([
+            self[position].data.media_item_id for position in positions
+        ])
+
     @db_session
     def item_at_position(self, position):
         return self.provider.ITEM_CLASS.get(
@@ -176,12 +283,7 @@ class CachedFeedProviderDataTable(ProviderDataTable):
             self.focus_position = pos
             self._modified()
         elif key == "A":
-            with db_session:
-                if self.provider.feed:
-                    self.provider.feed.mark_all_items_read()
-                else:
-                    self.provider.FEED_CLASS.mark_all_feeds_read()
-            self.reset()
+            self.mark_all_read()
         elif key == "u":
             self.toggle_item_read(self.focus_position)
             self.ignore_blur = True
@@ -202,6 +304,42 @@ class ItemStatusFilter(ListingFilter):
         for s in ["All", "Unread", "Not Downloaded"]
     ])
 
+class ItemSearchFilter(TextFilter):
+
+    # how long to wait after the last keystroke before searching
+    SEARCH_DELAY = 0.3
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.search_task = None
+        self.searched = ""
+        self.widget.connect("selected", self.changed)
+        urwid.connect_signal(
+            self.widget.edit, "postchange",
+            lambda w, v: self.on_edit()
+        )
+
+    @property
+    def widget_args(self):
+        return [""]
+
+    def on_edit(self):
+        if self.search_task:
+            self.search_task.cancel()
+        self.search_task = state.asyncio_loop.call_later(
+            self.SEARCH_DELAY, self.changed
+        )
+
+    def changed(self):
+        if self.search_task:
+            self.search_task.cancel()
+            self.search_task = None
+        if self.value == self.searched:
+            return
+        self.searched = self.value
+        super().changed()
+
+
 class FeedProvider(BaseProvider):
     """
     A provider that offers multiple feeds to select from
@@ -239,6 +377,18 @@ class CachedFeedProvider(BackgroundTasksMixin, FeedProvider):
 
     UPDATE_INTERVAL = 300
 
+    # how many feeds are fetched at once, and how long each one gets
+    UPDATE_CONCURRENCY = 8
+    UPDATE_TIMEOUT = 120
+
+    FILTERS = AttrDict(
+        FeedProvider.FILTERS,
+        **dict(search = ItemSearchFilter)
+    )
+
+    # sort columns that can be used for keyset pagination
+    KEYSET_SORT_TYPES = (int, str, datetime)
+
     TASKS = [
         ("update", UPDATE_INTERVAL, [], {"force": True})
     ]
@@ -246,8 +396,13 @@ class CachedFeedProvider(BackgroundTasksMixin, FeedProvider):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.items_query = None
+        self.search_results = None
+        self.updating = False
+        self.update_executor = None
+        self.update_stats = AttrDict()
         self.filters["feed"].connect("changed", self.on_feed_change)
         self.filters["status"].connect("changed", self.on_status_change)
+        self.filters["search"].connect("changed", self.on_search_change)
         self.game_map = AttrDict()
 
     @property
@@ -285,8 +440,8 @@ class CachedFeedProvider(BackgroundTasksMixin, FeedProvider):
                 (f, f) for f in self.config.feeds
             ])
 
-    @db_session
     def create_feeds(self):
+        # run by the database writer, which commits
         for name, locator in self.feeds.items():
             feed = self.FEED_CLASS.get(locator=locator)
             if not feed:
@@ -296,47 +451,196 @@ class CachedFeedProvider(BackgroundTasksMixin, FeedProvider):
                     locator=self.filters.feed[name]
                     # **self.feed_attrs(name)
                 )
-                commit()
 
     def feed_attrs(self, feed_name):
         return {}
 
-    @db_session
-    def update_feeds(self, force=False):
+    @property
+    def update_concurrency(self):
+        return self.config.get("update_concurrency") or self.UPDATE_CONCURRENCY
+
+    @property
+    def update_timeout(self):
+        return self.config.get("update_timeout") or self.UPDATE_TIMEOUT
+
+    def feeds_to_update(self, force=False):
+        with db_session:
+            if not self.feed:
+                feeds = self.FEED_CLASS.select()[:]
+            else:
+                feeds = [self.feed]
+
+            return [
+                f.channel_id for f in feeds
+                if (force
+                    or
+                    f.updated is None
+                    or
+                    datetime.now() - f.updated
+                    > timedelta(seconds=f.update_interval)
+                )
+            ]
+
+    async def update_feeds(self, force=False):
+        """
+        Update feeds in parallel, up to `update_concurrency` at a time, giving
+        up on any that take longer than `update_timeout` seconds to fetch.
+        Fetching happens on a pool of threads, and the results are all stored
+        by the database writer.
+        """
         logger.info("update_feeds")
-        if not self.feed:
-            feeds = self.FEED_CLASS.select()
-        else:
-            feeds = [self.feed]
-
-        for f in feeds:
-            if (force
-                or
-                f.updated is None
-                or
-                datetime.now() - f.updated
-                > timedelta(seconds=f.update_interval)
-            ):
-                logger.info(f"update {f}")
-                for item in f.update():
-                    # listing = self.item_to_listing(item)
-                    # print(item)
-                    listing = self.new_listing(
-                        # feed = f.to_dict(),
-                        **item.to_dict(
-                            exclude=["media_item_id", "feed", "classtype"],
-                            related_objects=True
-                        )
-                    )
-                    listing.content = self.MEDIA_SOURCE_CLASS.schema().loads(listing["content"], many=True)
-                    self.on_new_listing(listing)
-                    # raise Exception(listing)
-                f.updated = datetime.now()
+        feed_ids = self.feeds_to_update(force)
+        if not feed_ids:
+            return
+        if not self.update_executor:
+            self.update_executor = ThreadPoolExecutor(
+                max_workers=self.update_concurrency,
+                thread_name_prefix=f"{self.IDENTIFIER}-update"
+            )
+        semaphore = asyncio.Semaphore(self.update_concurrency)
+
+        async def update(feed_id):
+            async with semaphore:
+                return await self.update_feed(feed_id)
+
+        start = time.monotonic()
+        names = await asyncio.gather(*[update(feed_id) for feed_id in feed_ids])
+        elapsed = time.monotonic() - start
+
+        slowest = sorted(
+            [name for name in names if self.update_stats[name].fetch],
+            key=lambda name: self.update_stats[name].fetch, reverse=True
+        )[:3]
+        logger.info(
+            f"updated {len(feed_ids)} feeds in {elapsed:.2f}s, slowest: "
+            + ", ".join(
+                f"{name} ({self.update_stats[name].fetch:.2f}s)"
+                for name in slowest
+            )
+        )
+
+    def fetch_feed(self, feed_id):
+        with db_session:
+            f = self.FEED_CLASS[feed_id]
+            logger.info(f"update {f}")
+            return list(f.fetch())
+
+    @db_session
+    def new_listings(self, new_ids):
+        listings = []
+        for item in self.ITEM_CLASS.select(
+                lambda i: i.media_item_id in new_ids
+        ).order_by(lambda i: i.media_item_id):
+            # listing = self.item_to_listing(item)
+            # print(item)
+            listing = self.new_listing(
+                # feed = f.to_dict(),
+                **item.to_dict(
+                    exclude=["media_item_id", "feed", "classtype"],
+                    related_objects=True
+                )
+            )
+            listing.content = self.MEDIA_SOURCE_CLASS.from_content(listing["content"])
+            listings.append(listing)
+        return listings
+
+    async def update_feed(self, feed_id):
+        """
+        Fetch one feed and store its new items, recording how long each step
+        took in `update_stats`.  Returns the feed's name.
+        """
+        loop = asyncio.get_running_loop()
+        with db_session:
+            name = self.FEED_CLASS[feed_id].name
+        stats = self.update_stats[name] = AttrDict(
+            fetch = None, ingest = None, fetched = 0, added = 0, error = None
+        )
+        started = loop.create_future()
+
+        def fetch():
+            loop.call_soon_threadsafe(started.set_result, time.monotonic())
+            return self.fetch_feed(feed_id)
+
+        # the timeout runs from when a worker picks the feed up rather than
+        # from when it was queued.  A fetch that times out can't be
+        # interrupted, but the session's request timeout keeps it from
+        # holding its thread for much longer.
+        job = loop.run_in_executor(self.update_executor, fetch)
+        await asyncio.wait([started, job], return_when=asyncio.FIRST_COMPLETED)
+        start = started.result() if started.done() else time.monotonic()
+        try:
+            rows = await asyncio.wait_for(
+                job, max(0, start + self.update_timeout - time.monotonic())
+            )
+        except asyncio.TimeoutError:
+            logger.warning(f"{name}: timed out after {self.update_timeout}s")
+            stats.error = "timeout"
+            return name
+        except Exception as e:
+            logger.warning(f"{name}: update failed: {e}")
+            stats.error = str(e)
+            return name
+        stats.fetch = time.monotonic() - start
+        stats.fetched = len(rows)
+
+        # hand the new items to the database writer to be stored along with
+        # whatever else is being written
+        start = time.monotonic()
+        try:
+            new_ids = await asyncio.wrap_future(
+                writer.db_writer.submit(
+                    lambda: self.FEED_CLASS[feed_id].ingest(rows)
+                )
+            )
+        except Exception as e:
+            logger.warning(f"{name}: couldn't store items: {e}")
+            stats.error = str(e)
+            return name
+        stats.ingest = time.monotonic() - start
+        stats.added = len(new_ids)
+        logger.info(
+            f"{name}: {stats.fetched} items ({stats.added} new), "
+            f"fetch {stats.fetch:.2f}s, ingest {stats.ingest:.2f}s"
+        )
+
+        # the listings are read on a worker thread, but handled here, since
+        # downloads they start are scheduled on the event loop
+        listings = await loop.run_in_executor(
+            self.update_executor, self.new_listings, new_ids
+        )
+        for listing in listings:
+            self.on_new_listing(listing)
+        return name
 
     @property
     def feed_filters(self):
         return None
 
+    @property
+    def search_query(self):
+        if not model.ITEM_SEARCH_AVAILABLE:
+            return None
+        return model.item_search_query(self.filters.search.value)
+
+    @db_session
+    def item_count(self):
+        """
+        Return the number of items matching the current query from the feed
+        counters or the search results, or None if the query has filters the
+        counters don't cover.
+        """
+        if self.search_results is not None:
+            return len(self.search_results)
+        if self.feed_filters:
+            return None
+        if self.feed:
+            feed_ids = [self.feed.channel_id]
+        else:
+            feed_ids = select(f.channel_id for f in self.FEED_CLASS)[:]
+        return model.MediaFeedCounts.count(
+            feed_ids, self.filters.status.value
+        )
+
     def on_feed_change(self, *args):
         self.reset()
         # state.asyncio_loop.create_task(self.refresh())
@@ -344,6 +648,9 @@ class CachedFeedProvider(BackgroundTasksMixin, FeedProvider):
     def on_status_change(self, *args):
         self.reset()
 
+    def on_search_change(self, *args):
+        self.reset()
+
     def open_popup(self):
         class UpdateMessage(BasePopUp):
             def __init__(self):
@@ -363,15 +670,20 @@ class CachedFeedProvider(BackgroundTasksMixin, FeedProvider):
     # @db_session
     async def update(self, force=False):
         logger.info(f"update: {force}")
+        if self.updating:
+            # the last update is still running
+            return
+        self.updating = True
         self.refresh()
-        self.create_feeds()
+        await asyncio.wrap_future(writer.db_writer.submit(self.create_feeds))
         # state.loop.draw_screen()
-        def update_feeds():
-            self.open_popup()
-            self.update_feeds(force=force)
+        self.open_popup()
+        try:
+            await self.update_feeds(force=force)
+        finally:
+            self.updating = False
             self.refresh()
             self.close_popup()
-        update_task = state.asyncio_loop.run_in_executor(None, update_feeds)
         # logger.info("-update bar")
         # state.loop.draw_screen()
         logger.info("-update")
@@ -401,6 +713,11 @@ class CachedFeedProvider(BackgroundTasksMixin, FeedProvider):
         # self.refresh()
         # self.update()
 
+    def on_deactivate(self):
+        if self.gui:
+            self.view.table.flush_read_states()
+        super().on_deactivate()
+
 
     @db_session
     def update_query(self):
@@ -411,19 +728,34 @@ class CachedFeedProvider(BackgroundTasksMixin, FeedProvider):
             "not_downloaded": lambda i: i.downloaded is None
         }
 
+        # media_item_id breaks ties so that keyset pagination has a stable
+        # position to continue from
         (sort_field, sort_desc) = self.view.table.sort_by
         if sort_desc:
-            sort_fn = lambda i: desc(getattr(i, sort_field))
+            sort_fn = lambda i: (desc(getattr(i, sort_field)),
+                                 desc(i.media_item_id))
         else:
-            sort_fn = lambda i: getattr(i, sort_field)
+            sort_fn = lambda i: (getattr(i, sort_field), i.media_item_id)
 
+        # the raw SQL below refers to items by the "i" alias given here
         self.items_query = (
-            self.ITEM_CLASS.select()
-            .order_by(sort_fn)
+            self.ITEM_CLASS.select(lambda i: True)
             .filter(status_filters[self.filters.status.value])
                 # [offset:offset+limit]
         )
 
+        search = self.search_query
+        if search:
+            table = model.ITEM_SEARCH_TABLE
+            self.items_query = self.items_query.filter(
+                lambda i: raw_sql(
+                    f'"i"."media_item_id" IN (SELECT rowid FROM {table}'
+                    f' WHERE {table} MATCH $search)'
+                )
+            )
+        else:
+            self.items_query = self.items_query.order_by(sort_fn)
+
         if self.feed_filters:
             for f in self.feed_filters:
                 self.items_query = self.items_query.filter(f)
@@ -432,10 +764,52 @@ class CachedFeedProvider(BackgroundTasksMixin, FeedProvider):
             self.items_query = self.items_query.filter(
                 lambda i: i.feed == self.feed
             )
+
+        self.search_results = self.rank_search_results(search) if search else None
         self.view.table.update_count = True
 
+    def rank_search_results(self, search):
+        """
+        Return the ids of the items matching the current query, best matches
+        first.  The full text index is queried once, ranking every match with
+        bm25() as it goes, and the other filters are applied to the matches
+        with a second query, so that pages can be sliced from the result
+        without ranking any rows again.
+        """
+        weights = ", ".join(str(w) for w in model.ITEM_SEARCH_WEIGHTS)
+        table = model.ITEM_SEARCH_TABLE
+        ranked = model.db.select(
+            f"SELECT rowid FROM {table} WHERE {table} MATCH $search"
+            f" ORDER BY bm25({table}, {weights}), rowid DESC"
+        )
+        matches = set(select(i.media_item_id for i in self.items_query))
+        return [item_id for item_id in ranked if item_id in matches]
+
+
+    def seek(self, query, cursor):
+        """
+        Restrict the query to the rows after the cursor in the current sort
+        order, or return None if the cursor can't be used with that order.
+        """
+        if not isinstance(cursor, model.MediaListing):
+            return None
+        if self.search_query:
+            # ranked by relevance, which has no column to seek on
+            return None
+        (sort_field, sort_desc) = self.view.table.sort_by
+        attr = getattr(self.ITEM_CLASS, sort_field, None)
+        if (not isinstance(attr, Attribute)
+            or attr.py_type not in self.KEYSET_SORT_TYPES):
+            return None
+        return self.ITEM_CLASS.seek(query, sort_field, sort_desc, cursor)
 
-    def listings(self, offset=None, limit=None, *args, **kwargs):
+    def listings(self, offset=None, limit=None, *args, cursor=None, **kwargs):
+        """
+        Yield a page of listings from the current query.  If `cursor` (the
+        last listing already loaded) is given, the page starts right after it
+        using keyset pagination, so deep pages cost the same as the first.
+        Otherwise the page starts at `offset`.
+        """
 
         count = 0
 
@@ -446,7 +820,23 @@ class CachedFeedProvider(BackgroundTasksMixin, FeedProvider):
 
         with db_session:
 
-            for item in self.items_query[offset:offset+limit]:
+            query = self.seek(self.items_query, cursor) if cursor else None
+            if self.search_results is not None:
+                ids = self.search_results[offset:offset+limit]
+                found = dict(
+                    (i.media_item_id, i)
+                    for i in self.ITEM_CLASS.select(
+                        lambda i: i.media_item_id in ids
+                    )
+                )
+                # items deleted since the search are left out
+                items = [found[i] for i in ids if i in found]
+            elif query is not None:
+                items = query[:limit]
+            else:
+                items = self.items_query[offset:offset+limit]
+
+            for item in items:
                 # listing = self.item_to_listing(item)
                 listing = self.new_listing(
                     feed = AttrDict(item.feed.to_dict()),
@@ -455,5 +845,5 @@ class CachedFeedProvider(BackgroundTasksMixin, FeedProvider):
                         related_objects=True
                     )
                 )
-                listing.content = self.MEDIA_SOURCE_CLASS.schema().loads(listing["content"], many=True)
+                listing.content = self.MEDIA_SOURCE_CLASS.from_content(listing["content"])
                 yield(listing)
@@ -50,7 +50,8 @@ class InstagramSession(session.StreamSession):
             warnings.simplefilter("ignore")
             self.web_api = Client(
                 proxy=self.proxies.get("https") if self.proxies else None,
-                auto_patch=True, drop_incompat_keys=False
+                auto_patch=True, drop_incompat_keys=False,
+                timeout=self.request_timeout
             )
         self.end_cursors = DefaultAttrDict(lambda: None)
 
@@ -115,9 +116,9 @@ class InstagramSession(session.StreamSession):
                         self.provider.new_media_source(
                             m["video_url"], media_type="video"
                         )
-                        if m["type"] == "video"
-                        else None
                         for m in post["node"]["carousel_media"]
+                        # skip anything that isn't an image or a video
+                        if m and m.get("type") in ["image", "video"]
                     ]
                 else:
                     post_type = "image"
@@ -151,7 +152,7 @@ class InstagramFeed(model.MediaFeed):
 
     ITEM_CLASS = InstagramItem
 
-    def update(self, limit = None):
+    def fetch(self, limit = None):
 
         if self.locator.startswith("@"):
             user_name = self.name[1:]
@@ -163,36 +164,36 @@ class InstagramFeed(model.MediaFeed):
 
         last_count = 0
         count = 0
+        seen = set()
         while(count < limit):
             # instagram API will sometimes give duplicates using end_cursor
             # for pagination, so instead of specifying how many posts to get,
             # we just get a batch of them at a time and break the loop after
             # we've gotten the desired number of posts, or after a batch
             # entirely comprised of duplicates
-            for post in self.session.get_feed_items(user_name):
-                with db_session:
-                    i = self.items.select(lambda i: i.guid == post.guid).first()
-                    if not i:
-                        i = self.ITEM_CLASS(
-                            feed = self,
-                            guid = post.guid,
-                            title = post.title,
-                            created = post.created,
-                            post_type = post.post_type,
-                            content =  InstagramMediaSource.schema().dumps(
-                                post.content
-                                if isinstance(post.content, list)
-                                else [post.content],
-                                many=True
-                            )
-                        )
-                        count += 1
-                        yield i
+            posts = list(self.session.get_feed_items(user_name))
+            existing = self.existing_guids(post.guid for post in posts)
+            for post in posts:
+                if post.guid in existing or post.guid in seen:
+                    continue
+                seen.add(post.guid)
+                count += 1
+                yield dict(
+                    guid = post.guid,
+                    title = post.title,
+                    created = post.created,
+                    post_type = post.post_type,
+                    content =  InstagramMediaSource.to_content(
+                        post.content
+                        if isinstance(post.content, list)
+                        else [post.content]
+                    )
+                )
 
-                if count == last_count:
-                    logger.info(f"breaking after {count}")
-                    return
-                last_count = count
+            if count == last_count:
+                logger.info(f"breaking after {count}")
+                return
+            last_count = count
 
 
         # logger.info(self.end_cursor)
@@ -1,6 +1,7 @@
 from ..state import *
 
 from .base import *
+from .. import writer
 
 from dataclasses import *
 import abc
@@ -21,8 +22,8 @@ class LiveStreamProviderDataTable(ProviderDataTable):
     def keypress(self, size, key):
 
         if key == "meta r":
-            self.provider.update()
-            self.reset()
+            # update() refreshes the view once the channels are written
+            asyncio.create_task(self.provider.update())
         else:
             return super().keypress(size, key)
         return key
@@ -85,8 +86,8 @@ class LiveStreamProvider(BackgroundTasksMixin, BaseProvider):
                 (f, f) for f in self.config.channels
             ])
 
-    @db_session
     def create_channels(self):
+        # run by the database writer, which commits
         for name, locator in self.channels.items():
             feed = self.CHANNEL_CLASS.get(locator=locator)
             if not feed:
@@ -96,16 +97,14 @@ class LiveStreamProvider(BackgroundTasksMixin, BaseProvider):
                     locator=self.filters.channel[name]
                     # **self.feed_attrs(name)
                 )
-                commit()
 
     def listings(self, offset=None, limit=None, *args, **kwargs):
 
         return self.live_channels
 
 
-    @db_session
-    def update(self):
-        self.create_channels()
+    async def update(self):
+        await asyncio.wrap_future(writer.db_writer.submit(self.create_channels))
         self.refresh()
 
     @db_session
@@ -116,16 +115,25 @@ class LiveStreamProvider(BackgroundTasksMixin, BaseProvider):
             channels = self.channels
 
         self.live_channels = list()
+        checked = list()
         for locator in channels:
             channel = self.CHANNEL_CLASS.get(locator=locator)
             if not channel:
                 raise Exception
 
             listing = self.check_channel(locator)
-            channel.updated = datetime.now()
+            checked.append(channel.channel_id)
             if listing and listing.channel not in [l.channel for l in self.live_channels]:
                 self.live_channels.append(listing)
 
+        updated = datetime.now()
+        channel_class = self.CHANNEL_CLASS
+
+        def mark_updated():
+            for c in channel_class.select(lambda c: c.channel_id in checked):
+                c.updated = updated
+
+        writer.db_writer.submit(mark_updated)
         self.view.refresh()
 
 
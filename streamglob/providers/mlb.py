@@ -705,7 +705,9 @@ class MLBProvider(BAMProviderMixin,
         sports_url = (
             "http://statsapi.mlb.com/api/v1/sports"
         )
-        with self.session.cache_responses_long():
+        with self.session.cache_responses_long(
+                stale_while_revalidate=model.CACHE_DURATION_LONG
+        ):
             sports = self.session.get(sports_url).json()
 
         sport = next(s for s in sports["sports"] if s["code"] == sport_code)
@@ -721,7 +723,9 @@ class MLBProvider(BAMProviderMixin,
 
         # raise Exception(state.session.get(teams_url).json())
 
-        with self.session.cache_responses_long():
+        with self.session.cache_responses_long(
+                stale_while_revalidate=model.CACHE_DURATION_LONG
+        ):
             teams = AttrDict(
                 (team["abbreviation"].lower(), team["id"])
                 for team in sorted(self.session.get(teams_url).json()["teams"],
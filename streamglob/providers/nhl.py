@@ -8,6 +8,7 @@ from panwid.datatable import *
 from pony.orm import *
 
 from .. import session
+from .. import model
 
 from .base import *
 from .bam import *
@@ -402,7 +403,9 @@ class NHLProvider(BAMProviderMixin,
         )
 
         # FIXME
-        with self.session.cache_responses_long():
+        with self.session.cache_responses_long(
+                stale_while_revalidate=model.CACHE_DURATION_LONG
+        ):
             teams = AttrDict(
                 (team["abbreviation"].lower(), team["id"])
                 for team in sorted(self.session.get(teams_url).json()["teams"],
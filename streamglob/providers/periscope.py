@@ -38,7 +38,7 @@ class PeriscopeFeed(model.MediaFeed):
 
     ITEM_CLASS = PeriscopeItem
 
-    def update(self, limit=None):
+    def fetch(self, limit=None):
 
         if not limit:
             limit = self.DEFAULT_ITEM_LIMIT
@@ -47,31 +47,33 @@ class PeriscopeFeed(model.MediaFeed):
             for item in self.session.peri.get_user_broadcast_history(
                     username=self.locator
             ):
-                guid = item["id"]
-                with db_session:
-                    i = self.ITEM_CLASS.upsert(
-                        dict(
-                            feed = self.channel_id,
-                            guid = guid
-                        ),
-                        dict(
-                            title = item["status"].strip() or "-",
-                            content = PeriscopeMediaSource.schema().dumps(
-                                [self.provider.new_media_source(
-                                    f"https://pscp.tv/w/{item['id']}",
-                                    media_type="video")],
-                                many=True,
-                            ),
-                            created = dateutil.parser.parse(item["created_at"]).replace(tzinfo=None),
-                            is_live = item.get("state") == "RUNNING"
-
-                        )
-                    )
-                    yield i
-
+                yield dict(
+                    guid = item["id"],
+                    title = item["status"].strip() or "-",
+                    content = PeriscopeMediaSource.to_content(
+                        [self.provider.new_media_source(
+                            f"https://pscp.tv/w/{item['id']}",
+                            media_type="video")]
+                    ),
+                    created = dateutil.parser.parse(item["created_at"]).replace(tzinfo=None),
+                    is_live = item.get("state") == "RUNNING"
+                )
         except pyperi.PyPeriConnectionError as e:
             logger.warning(e)
 
+    @db_session
+    def ingest(self, rows):
+        # broadcasts already seen may have changed state or title, so update
+        # them too, unless they've since been purged
+        archived = self.archived_guids(row["guid"] for row in rows)
+        result = self.ITEM_CLASS.bulk_upsert(
+            ["feed", "guid"],
+            [dict(row, feed=self.channel_id)
+             for row in rows if row["guid"] not in archived]
+        )
+        self.updated = datetime.now()
+        return result.inserted
+
 class PeriscopeLiveStreamFilter(ListingFilter):
 
     values = AttrDict([
@@ -5,6 +5,7 @@ from ..state import *
 from .. import config
 from .. import model
 from .. import session
+from .. import utils
 
 from .filters import *
 
@@ -31,7 +32,7 @@ class RSSSession(session.StreamSession):
 
     def parse(self, url):
         try:
-            content = self.session.get(url).content
+            content = self.get(url, timeout=self.request_timeout).content
         except requests.exceptions.ConnectionError as e:
             logger.exception(e)
             raise SGFeedUpdateFailedException
@@ -49,38 +50,40 @@ class RSSFeed(model.MediaFeed):
 
     ITEM_CLASS = RSSItem
 
-    # @db_session
-    def update(self, limit = None):
+    def fetch(self, limit = None):
 
         if not limit:
             limit = self.DEFAULT_ITEM_LIMIT
 
         try:
-            for item in self.session.parse(self.locator).items:
-                with db_session:
-                    guid = getattr(item, "guid", item.link) or item.link
-                    i = self.items.select(lambda i: i.guid == guid).first()
-                    if not i:
-                        source = self.provider.new_media_source(
-                            url=item.link,
-                            media_type="video" # FIXME: could be something else
-                        )
-                        i = self.ITEM_CLASS(
-                            feed = self,
-                            guid = guid,
-                            title = item.title,
-                            created = item.pub_date.replace(tzinfo=None),
-                            # created = datetime.fromtimestamp(
-                            #     mktime(item.published_parsed)
-                            # ),
-                            content = RSSMediaSource.schema().dumps(
-                                [source],
-                                many=True
-                            )
-                        )
-                        yield i
+            items = dict(
+                (getattr(item, "guid", item.link) or item.link, item)
+                for item in self.session.parse(self.locator).items
+            )
         except SGFeedUpdateFailedException:
             logger.warn(f"couldn't update feed {self.name}")
+            return
+
+        existing = self.existing_guids(items.keys())
+        for guid, item in items.items():
+            if guid in existing:
+                continue
+            source = self.provider.new_media_source(
+                url=item.link,
+                media_type="video" # FIXME: could be something else
+            )
+            yield dict(
+                guid = guid,
+                title = item.title,
+                description = utils.strip_html(item.description or ""),
+                created = item.pub_date.replace(tzinfo=None),
+                # created = datetime.fromtimestamp(
+                #     mktime(item.published_parsed)
+                # ),
+                content = RSSMediaSource.to_content(
+                    [source]
+                )
+            )
 
 
 
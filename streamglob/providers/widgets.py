@@ -59,7 +59,20 @@ class ProviderDataTable(BaseDataTable):
     def limit(self):
         return self.provider.limit
 
+    def query_cursor(self, offset):
+        """
+        Return the position that a query starting at `offset` continues from,
+        for providers that support keyset pagination, or None.
+        """
+        return None
+
     def query(self, *args, **kwargs):
+        # panwid passes the last row's sort value as the cursor, which the
+        # providers can't use, so replace it with our own, if any
+        kwargs.pop("cursor", None)
+        cursor = self.query_cursor(kwargs.get("offset"))
+        if cursor is not None:
+            kwargs["cursor"] = cursor
         try:
             for l in self.provider.listings(*args, **kwargs):
                 # FIXME
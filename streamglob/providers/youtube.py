@@ -58,6 +58,7 @@ class YouTubeSession(session.StreamSession):
             'extract_flat': "in_playlist",
             "playlistend": limit,
             'proxy': self.proxies.get("https", None) if self.proxies else None,
+            'socket_timeout': self.request_timeout,
             'logger': logger
         }
 
@@ -182,26 +183,27 @@ class YouTubeFeed(model.MediaFeed):
 
     ITEM_CLASS = YouTubeItem
 
-    def update(self, limit = None):
+    def fetch(self, limit = None):
 
         if not limit:
             limit = self.DEFAULT_ITEM_LIMIT
 
-        for item in self.session.youtube_dl_query(self.locator, limit=limit):
-            with db_session:
-                i = self.items.select(lambda i: i.guid == item["guid"]).first()
-
-                url = item.pop("url")
-                if not i:
-                    i = self.ITEM_CLASS(
-                        feed=self,
-                        content = YouTubeMediaSource.schema().dumps(
-                            [self.provider.new_media_source(url, media_type="video")],
-                            many=True
-                        ),
-                        **item
-                    )
-                    yield i
+        items = dict(
+            (item["guid"], item)
+            for item in self.session.youtube_dl_query(self.locator, limit=limit)
+        )
+
+        existing = self.existing_guids(items.keys())
+        for guid, item in items.items():
+            if guid in existing:
+                continue
+            url = item.pop("url")
+            yield dict(
+                content = YouTubeMediaSource.to_content(
+                    [self.provider.new_media_source(url, media_type="video")]
+                ),
+                **item
+            )
 
 class TemplateIngoreMissingDict(dict):
 
@@ -214,6 +216,7 @@ class YouTubeProvider(PaginatedProviderMixin,
     FILTERS = AttrDict([
         ("feed", YouTubeChannelsFilter),
         ("status", ItemStatusFilter),
+        ("search", ItemSearchFilter),
     ])
 
     FEED_CLASS = YouTubeFeed
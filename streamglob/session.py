@@ -6,8 +6,15 @@ import base64
 import binascii
 import json
 import sqlite3
-import pickle
 import functools
+import asyncio
+import contextvars
+import threading
+import time
+import atexit
+import weakref
+import email.utils
+from concurrent.futures import ThreadPoolExecutor, Future
 from contextlib import contextmanager
 
 from http.cookiejar import LWPCookieJar, Cookie
@@ -26,6 +33,9 @@ from pony.orm import *
 
 from . import config
 from . import model
+from . import cache
+from . import transport
+from . import utils
 from . import providers
 from .state import *
 from .exceptions import *
@@ -35,6 +45,131 @@ USER_AGENT = (
     "Gecko/20100101 Firefox/66.0"
 )
 
+class SingleFlight(object):
+    """
+    Coalesces concurrent calls sharing the same key into a single call whose
+    result (or exception) is handed to every caller.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = dict()
+        self.shared = 0
+
+    def do(self, key, fn):
+        with self.lock:
+            future = self.calls.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self.calls[key] = future
+            else:
+                self.shared += 1
+
+        if not leader:
+            return future.result()
+
+        try:
+            result = fn()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+        finally:
+            with self.lock:
+                del self.calls[key]
+        return result
+
+
+class TokenBucket(object):
+    """
+    Thread-safe token bucket rate limiter allowing `rate` requests per second
+    on average, with bursts of up to `burst` requests.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = burst or max(1, int(self.rate))
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+        self.waits = 0
+        self.wait_time = 0.0
+
+    def acquire(self):
+        """
+        Take a token, sleeping until one is available.  Returns the number of
+        seconds spent waiting.
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.burst, self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+            self.tokens -= 1
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0
+            if delay:
+                self.waits += 1
+                self.wait_time += delay
+        if delay:
+            time.sleep(delay)
+        return delay
+
+
+class RetryPolicy(object):
+    """
+    Exponential backoff policy for failed requests.  Connection errors and
+    responses with one of the `statuses` are retried up to `max_retries` times,
+    waiting `backoff * 2**attempt` seconds (capped at `max_backoff`) in between,
+    or however long the server asks for in a Retry-After header.
+    """
+
+    RETRY_METHODS = {"GET", "HEAD", "OPTIONS", "PUT", "DELETE"}
+
+    def __init__(self, max_retries=2, backoff=0.5, max_backoff=60,
+                 statuses=(429, 500, 502, 503, 504)):
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.statuses = set(statuses)
+        self.retries = 0
+
+    def should_retry(self, method, attempt, response=None):
+        return (
+            attempt < self.max_retries
+            and method.upper() in self.RETRY_METHODS
+            and (response is None or response.status_code in self.statuses)
+        )
+
+    def delay(self, attempt, response=None):
+        retry_after = response.headers.get("Retry-After") if response is not None else None
+        if retry_after:
+            try:
+                return min(self.max_backoff, max(0, int(retry_after)))
+            except ValueError:
+                try:
+                    when = email.utils.parsedate_to_datetime(retry_after)
+                    return min(
+                        self.max_backoff,
+                        max(0, (when - datetime.now(when.tzinfo)).total_seconds())
+                    )
+                except (TypeError, ValueError):
+                    pass
+        return min(self.max_backoff, self.backoff * 2**attempt)
+
+
+# every live session, so that unsaved state can be written on exit without
+# keeping the sessions alive until then
+SESSIONS = weakref.WeakSet()
+
+@atexit.register
+def flush_sessions():
+    for session in list(SESSIONS):
+        session.flush()
+
+
 class StreamSession(object):
     """
     Top-level stream session interface
@@ -49,6 +184,26 @@ class StreamSession(object):
         "User-agent": USER_AGENT
     }
 
+    HTTP_METHODS = ["delete", "get", "head", "options", "post", "put", "patch"]
+
+    # Size of the thread pool backing the awaitable request methods (aget,
+    # apost, etc.)  Can be overridden per-provider with the
+    # `session.max_workers` config setting.
+    MAX_WORKERS = 8
+
+    # Seconds to wait to connect or for data before giving up on a request,
+    # unless the caller gives a timeout.  Can be overridden per-provider with
+    # the `session.timeout` config setting.
+    REQUEST_TIMEOUT = 30
+
+    # Requests with any of these arguments are never cached or shared with
+    # another caller, since the key doesn't account for them
+    UNSHARED_ARGS = ["data", "json", "files", "auth", "cookies"]
+
+    # Seconds to wait after a call to save() before writing the session state,
+    # so that bursts of changes (e.g. during login) result in a single write.
+    SAVE_DELAY = 1.0
+
     def __init__(
             self,
             provider_id,
@@ -58,17 +213,39 @@ class StreamSession(object):
 
         self.provider_id = provider_id
         self.session = requests.Session()
+        transport.mount_adapters(
+            self.session,
+            self.session_config.get("pool"),
+            self.session_config.get("replay")
+        )
         self.cookies = LWPCookieJar()
-        if not os.path.exists(self.COOKIES_FILE):
-            self.cookies.save(self.COOKIES_FILE)
-        self.cookies.load(self.COOKIES_FILE, ignore_discard=True)
+        if os.path.exists(self.COOKIES_FILE):
+            self.cookies.load(self.COOKIES_FILE, ignore_discard=True)
         self.session.headers = self.HEADERS
         self._state = AttrDict([
             ("proxies", proxies)
         ])
         if proxies:
             self.proxies = proxies
-        self._cache_responses = False
+        # the policy set by cache_responses(), which only applies to requests
+        # made from the same thread or asyncio task
+        self._cache_policy = contextvars.ContextVar(
+            f"{provider_id}_cache_policy", default=False
+        )
+        self._executor = None
+        self._inflight = SingleFlight()
+        self._inflight_async = dict()
+        self._revalidating = set()
+        self._revalidating_lock = threading.Lock()
+        self.stale_served = 0
+        self.revalidations = 0
+        self._rate_limiter = None
+        self._retry_policy = None
+        self._dirty = False
+        self._save_timer = None
+        self._save_lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        SESSIONS.add(self)
 
     @property
     def provider(self):
@@ -127,57 +304,304 @@ class StreamSession(object):
         return cls(provider_id, **dict(kwargs, **state))
 
     def save(self):
-        logger.trace(f"load: {self.__class__.__name__}, {self._state}")
-        with open(self.SESSION_FILE, 'w') as outfile:
-            yaml.dump(self._state, outfile, default_flow_style=False)
-        self.cookies.save(self.COOKIES_FILE)
+        """
+        Mark the session state and cookies as needing to be written.  Writes
+        are coalesced over SAVE_DELAY seconds and done on a background thread
+        by flush().
+        """
+        with self._save_lock:
+            self._dirty = True
+            if self._save_timer is None:
+                self._save_timer = threading.Timer(self.SAVE_DELAY, self.flush)
+                self._save_timer.daemon = True
+                self._save_timer.start()
+
+    def flush(self):
+        """
+        Write the session state and cookies if they've changed since the last
+        write.  Each file is written to a temporary file and renamed into
+        place, so a crash can't leave a partially written file behind.
+        """
+        with self._save_lock:
+            if self._save_timer is not None:
+                self._save_timer.cancel()
+                self._save_timer = None
+            if not self._dirty:
+                return
+            self._dirty = False
+            logger.trace(f"save: {self.__class__.__name__}, {self._state}")
+            state = yaml.dump(self._state, default_flow_style=False)
+            cookies = LWPCookieJar()
+            # requests on other threads update the jar, and iterating over it
+            # doesn't take its lock
+            with self.cookies._cookies_lock:
+                saved = list(self.cookies)
+            for cookie in saved:
+                cookies.set_cookie(cookie)
+
+        with self._write_lock:
+            with utils.atomic_file(self.SESSION_FILE) as tmp:
+                with open(tmp, "w") as outfile:
+                    outfile.write(state)
+            with utils.atomic_file(self.COOKIES_FILE) as tmp:
+                cookies.save(tmp)
 
 
     def get_cookie(self, name):
         return requests.utils.dict_from_cookiejar(self.cookies).get(name)
 
     def __getattr__(self, attr):
-        if attr in ["delete", "get", "head", "options", "post", "put", "patch"]:
+        if attr in self.HTTP_METHODS:
             # return getattr(self.session, attr)
             session_method = getattr(self.session, attr)
             return functools.partial(self.request, session_method)
+        elif attr.startswith("a") and attr[1:] in self.HTTP_METHODS:
+            session_method = getattr(self.session, attr[1:])
+            return functools.partial(self.arequest, session_method)
         # raise AttributeError(attr)
 
-    @db_session
-    def request(self, method, url, *args, **kwargs):
+    @property
+    def session_config(self):
+        """
+        Transport settings from the `session` section of the profile, with any
+        settings in the `session` section of the provider config taking
+        precedence.
+        """
+        cfg = config.ConfigTree()
+        if config.settings:
+            cfg = config.dict_merge(
+                cfg, config.settings.profile.get("session") or {}
+            )
+        try:
+            cfg = config.dict_merge(
+                cfg, self.provider.config.get("session") or {}
+            )
+        except AttributeError:
+            pass
+        return cfg
 
-        response = None
-        use_cache = not self.no_cache and self._cache_responses
-        # print(self.proxies)
-        if use_cache:
-            logger.debug("getting cached response for %s" %(url))
+    @property
+    def max_workers(self):
+        return self.session_config.get("max_workers") or self.MAX_WORKERS
 
-            e = model.CacheEntry.get(url=url)
+    @property
+    def request_timeout(self):
+        return self.session_config.get("timeout") or self.REQUEST_TIMEOUT
 
-            if e:
-                # (pickled_response, last_seen) = self.cursor.fetchone()
+    @property
+    def executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.max_workers,
+                thread_name_prefix=f"{self.provider_id}-session"
+            )
+        return self._executor
+
+    @property
+    def rate_limiter(self):
+        if self._rate_limiter is None:
+            cfg = self.session_config.get("rate_limit")
+            if cfg:
+                self._rate_limiter = TokenBucket(**cfg)
+            else:
+                self._rate_limiter = False
+        return self._rate_limiter
+
+    @property
+    def retry_policy(self):
+        if self._retry_policy is None:
+            self._retry_policy = RetryPolicy(
+                **(self.session_config.get("retry") or {})
+            )
+        return self._retry_policy
+
+    @property
+    def stats(self):
+        return AttrDict(
+            rate_limit_waits = self.rate_limiter.waits if self.rate_limiter else 0,
+            rate_limit_wait_time = self.rate_limiter.wait_time if self.rate_limiter else 0,
+            retries = self.retry_policy.retries,
+            coalesced = self._inflight.shared,
+            stale_served = self.stale_served,
+            revalidations = self.revalidations,
+            **transport.adapter_stats(self.session)
+        )
 
-                td = datetime.now() - e.last_seen
-                if td.seconds >= self._cache_responses:
-                    logger.debug("cache expired for %s" %(url))
-                else:
-                    response = pickle.loads(e.response)
-                    logger.debug("using cached response for %s" %(url))
+    def send(self, method, url, *args, **kwargs):
+        """
+        Make a request, throttled by the session's rate limiter and retried
+        according to its retry policy.
+        """
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = self.request_timeout
+        attempt = 0
+        while True:
+            if self.rate_limiter:
+                self.rate_limiter.acquire()
+            try:
+                response = method(url, *args, **kwargs)
+            except (requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout) as e:
+                if not self.retry_policy.should_retry(method.__name__, attempt):
+                    raise
+                response = None
+                logger.debug(f"retrying {url} after {e}")
             else:
-                logger.debug("no cached response for %s" %(url))
-
-        if not response:
-            response = method(url, *args, **kwargs)
-            # logger.trace(dump.dump_all(response).encode("utf-8"))
-
-        if use_cache and not e:
-            pickled_response = pickle.dumps(response)
-            e = model.CacheEntry(
-                url = url,
-                response = pickled_response,
-                last_seen = datetime.now()
+                if not self.retry_policy.should_retry(
+                        method.__name__, attempt, response):
+                    return response
+                logger.debug(f"retrying {url} after {response.status_code}")
+            time.sleep(self.retry_policy.delay(attempt, response))
+            self.retry_policy.retries += 1
+            attempt += 1
+
+    def request_key(self, method, url, **kwargs):
+        """
+        Return the key identifying this request in the response cache and the
+        table of in-flight requests, or None if it shouldn't be shared.
+        """
+        if (method.__name__.upper() not in cache.http_cache.CACHEABLE_METHODS
+            or kwargs.get("stream")
+            or any(kwargs.get(arg) is not None for arg in self.UNSHARED_ARGS)):
+            return None
+        headers = requests.structures.CaseInsensitiveDict(self.session.headers)
+        headers.update(kwargs.get("headers") or {})
+        return cache.http_cache.key(
+            method.__name__, url,
+            params=kwargs.get("params"),
+            headers=headers,
+            allow_redirects=kwargs.get("allow_redirects", True)
+        )
+
+    @property
+    def cache_policy(self):
+        return self._cache_policy.get()
+
+    def request(self, method, url, *args, **kwargs):
+        return self._request(
+            method, url, self.cache_policy, *args, **kwargs
+        )
+
+    def arequest(self, method, url, *args, **kwargs):
+        """
+        Awaitable version of request().  The request is started on the
+        session's thread pool right away, so that slow responses don't block
+        the event loop, and the cache policy in effect when arequest() is
+        called applies even if the result is awaited outside of the
+        cache_responses() block.
+
+        Identical requests made at the same time share a single fetch.
+        """
+        fetch = functools.partial(
+            self._request,
+            method, url, self.cache_policy, *args, **kwargs
+        )
+        key = self.request_key(method, url, **kwargs)
+        if key is None:
+            return asyncio.wrap_future(self.executor.submit(fetch))
+
+        future = self._inflight_async.get(key)
+        if future is None:
+            future = asyncio.wrap_future(self.executor.submit(fetch))
+            self._inflight_async[key] = future
+            future.add_done_callback(
+                lambda f: self._inflight_async.pop(key, None)
+            )
+        else:
+            self._inflight.shared += 1
+        return asyncio.shield(future)
+
+    def _request(self, method, url, cache_policy, *args, **kwargs):
+
+        key = self.request_key(method, url, **kwargs)
+        if key is None:
+            return self.send(method, url, *args, **kwargs)
+
+        return self._inflight.do(
+            key,
+            functools.partial(
+                self._fetch,
+                method, url, key, cache_policy, *args, **kwargs
+            )
+        )
+
+    def _fetch(self, method, url, key, cache_policy, *args, **kwargs):
+
+        use_cache = not self.no_cache and cache_policy
+        # print(self.proxies)
+        if not use_cache:
+            return self.send(method, url, *args, **kwargs)
+
+        logger.debug("getting cached response for %s" %(url))
+        entry = cache.http_cache.get(key)
+
+        if entry:
+            if entry.is_fresh(cache_policy.duration):
+                logger.debug("using cached response for %s" %(url))
+                return entry.to_response()
+            if (cache_policy.max_stale
+                and entry.is_fresh(cache_policy.duration + cache_policy.max_stale)):
+                logger.debug("using stale cached response for %s" %(url))
+                self.stale_served += 1
+                self.revalidate(
+                    method, url, key, entry, cache_policy, *args, **kwargs
+                )
+                return entry.to_response()
+            logger.debug("cache expired for %s" %(url))
+        else:
+            logger.debug("no cached response for %s" %(url))
+
+        return self._revalidate(
+            method, url, key, entry, cache_policy, *args, **kwargs
+        )
+
+    def revalidate(self, method, url, key, entry, cache_policy,
+                   *args, **kwargs):
+        """
+        Refresh a stale cache entry on the session's thread pool.  Only one
+        refresh per entry is in flight at a time.
+        """
+        with self._revalidating_lock:
+            if key in self._revalidating:
+                return
+            self._revalidating.add(key)
+
+        def refresh():
+            try:
+                self._revalidate(
+                    method, url, key, entry, cache_policy, *args, **kwargs
+                )
+                self.revalidations += 1
+            except Exception as e:
+                logger.warning(f"couldn't revalidate {url}: {e}")
+            finally:
+                with self._revalidating_lock:
+                    self._revalidating.discard(key)
+
+        self.executor.submit(refresh)
+
+    def _revalidate(self, method, url, key, entry, cache_policy,
+                    *args, **kwargs):
+
+        # entries that can still be served stale mustn't be evicted before
+        # they get the chance
+        keep = cache_policy.duration + (cache_policy.max_stale or 0)
+
+        if entry and entry.validators:
+            kwargs["headers"] = dict(
+                kwargs.get("headers") or {}, **entry.validators
             )
 
+        response = self.send(method, url, *args, **kwargs)
+        # logger.trace(dump.dump_all(response).encode("utf-8"))
+
+        if entry and response.status_code == 304:
+            logger.debug("cached response for %s still valid" %(url))
+            return cache.http_cache.touch(entry, keep).to_response()
+
+        if cache.http_cache.is_cacheable(method.__name__, response):
+            cache.http_cache.put(key, response, keep)
+
         return response
 
 
@@ -200,21 +624,38 @@ class StreamSession(object):
             self.session.proxies.update(value)
 
     @contextmanager
-    def cache_responses(self, duration=model.CACHE_DURATION_DEFAULT):
-        self._cache_responses = duration
+    def cache_responses(self, duration=model.CACHE_DURATION_DEFAULT,
+                        stale_while_revalidate=None):
+        """
+        Cache responses to GET requests made in this context for `duration`
+        seconds.
+
+        If `stale_while_revalidate` is given, responses up to that many seconds
+        past their expiry are returned immediately while a fresh copy is
+        fetched in the background.  Older responses are refetched before
+        returning, as usual.
+
+        The policy only applies to requests made from the current thread or
+        asyncio task, and the previous policy is restored on exit, so blocks
+        can be nested.
+        """
+        token = self._cache_policy.set(AttrDict(
+            duration = duration,
+            max_stale = stale_while_revalidate
+        ))
         try:
             yield
         finally:
-            self._cache_responses = False
+            self._cache_policy.reset(token)
 
-    def cache_responses_short(self):
-        return self.cache_responses(model.CACHE_DURATION_SHORT)
+    def cache_responses_short(self, **kwargs):
+        return self.cache_responses(model.CACHE_DURATION_SHORT, **kwargs)
 
-    def cache_responses_medium(self):
-        return self.cache_responses(model.CACHE_DURATION_MEDIUM)
+    def cache_responses_medium(self, **kwargs):
+        return self.cache_responses(model.CACHE_DURATION_MEDIUM, **kwargs)
 
-    def cache_responses_long(self):
-        return self.cache_responses(model.CACHE_DURATION_LONG)
+    def cache_responses_long(self, **kwargs):
+        return self.cache_responses(model.CACHE_DURATION_LONG, **kwargs)
 
 
 class AuthenticatedStreamSession(StreamSession):
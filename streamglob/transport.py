@@ -0,0 +1,261 @@
+import logging
+logger = logging.getLogger(__name__)
+
+import os
+import socket
+import threading
+import time
+import random
+import json
+import base64
+import hashlib
+from datetime import timedelta
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import BaseAdapter, HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from urllib3.connection import HTTPConnection
+from orderedattrdict import AttrDict
+
+from . import config
+from . import utils
+
+DEFAULT_POOL_MAXSIZE = 10
+
+class KeepAliveHTTPAdapter(HTTPAdapter):
+    """
+    HTTPAdapter with a configurable connection pool size that enables TCP
+    keep-alive on its sockets, so idle pooled connections survive long gaps
+    between feed refreshes.
+    """
+
+    def __init__(self, pool_maxsize=DEFAULT_POOL_MAXSIZE,
+                 keepalive=True, keepalive_idle=None, **kwargs):
+        self.keepalive = keepalive
+        self.keepalive_idle = keepalive_idle
+        super().__init__(
+            pool_connections=kwargs.pop("pool_connections", pool_maxsize),
+            pool_maxsize=pool_maxsize,
+            **kwargs
+        )
+
+    @property
+    def socket_options(self):
+        options = list(HTTPConnection.default_socket_options)
+        if self.keepalive:
+            options.append((socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1))
+            if self.keepalive_idle and hasattr(socket, "TCP_KEEPIDLE"):
+                options.append(
+                    (socket.IPPROTO_TCP, socket.TCP_KEEPIDLE,
+                     int(self.keepalive_idle))
+                )
+        return options
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs.setdefault("socket_options", self.socket_options)
+        super().init_poolmanager(*args, **kwargs)
+
+    @property
+    def stats(self):
+        pools = self.poolmanager.pools
+        connections = 0
+        requests = 0
+        for key in pools.keys():
+            pool = pools.get(key)
+            if not pool:
+                continue
+            connections += pool.num_connections
+            requests += pool.num_requests
+        return AttrDict(
+            pools = len(pools),
+            connections = connections,
+            requests = requests,
+            reused = max(0, requests - connections)
+        )
+
+
+class RecordReplayAdapter(BaseAdapter):
+    """
+    Transport adapter that records responses from a wrapped adapter to a
+    fixture directory ("record" mode), or serves previously recorded responses
+    without touching the network ("replay" mode).
+
+    In replay mode, `latency` seconds (plus up to `jitter` more) are added to
+    each response to simulate a real network.  A latency of "recorded" replays
+    the time the original request took.
+    """
+
+    def __init__(self, adapter, mode="replay", path=None,
+                 latency=0, jitter=0):
+        super().__init__()
+        if mode not in ["record", "replay"]:
+            raise ValueError(f"invalid record/replay mode: {mode}")
+        self.adapter = adapter
+        self.mode = mode
+        self.path = path or os.path.join(config.CONFIG_DIR, "fixtures")
+        self.latency = latency
+        self.jitter = jitter
+        self.recorded = 0
+        self.replayed = 0
+
+    def fixture_path(self, request):
+        body = request.body or b""
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        digest = hashlib.sha1(
+            b"\n".join([
+                request.method.encode("utf-8"),
+                request.url.encode("utf-8"),
+                body
+            ])
+        ).hexdigest()
+        return os.path.join(
+            self.path, urlparse(request.url).netloc or "_", f"{digest}.json"
+        )
+
+    def send(self, request, **kwargs):
+        if self.mode == "record":
+            return self.record(request, **kwargs)
+        return self.replay(request)
+
+    def record(self, request, **kwargs):
+        response = self.adapter.send(request, **kwargs)
+        fixture = dict(
+            method = request.method,
+            url = request.url,
+            status = response.status_code,
+            reason = response.reason,
+            headers = dict(response.headers),
+            encoding = response.encoding,
+            elapsed = response.elapsed.total_seconds(),
+            # reading content here also means streamed responses are fully
+            # buffered before they're returned
+            body = base64.b64encode(response.content).decode("ascii")
+        )
+        path = self.fixture_path(request)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with utils.atomic_file(path) as tmp:
+            with open(tmp, "w") as f:
+                json.dump(fixture, f, indent=4)
+        self.recorded += 1
+        return response
+
+    def replay(self, request):
+        path = self.fixture_path(request)
+        try:
+            with open(path) as f:
+                fixture = json.load(f)
+        except FileNotFoundError:
+            raise requests.exceptions.ConnectionError(
+                f"no recorded response for {request.method} {request.url}",
+                request=request
+            )
+
+        if self.latency == "recorded":
+            delay = fixture.get("elapsed", 0)
+        else:
+            delay = self.latency or 0
+        if self.jitter:
+            delay += random.uniform(0, self.jitter)
+        if delay:
+            time.sleep(delay)
+
+        response = requests.Response()
+        response.status_code = fixture["status"]
+        response.reason = fixture.get("reason")
+        response.headers = CaseInsensitiveDict(fixture["headers"])
+        # the recorded body has already been decoded
+        response.headers.pop("Content-Encoding", None)
+        response.encoding = fixture.get("encoding")
+        response.url = request.url
+        response.request = request
+        response.elapsed = timedelta(seconds=delay)
+        response._content = base64.b64decode(fixture["body"])
+        self.replayed += 1
+        return response
+
+    def close(self):
+        self.adapter.close()
+
+
+SHARED_ADAPTERS = dict()
+SHARED_ADAPTERS_LOCK = threading.Lock()
+
+def shared_adapter(host=None, **kwargs):
+    """
+    Return an adapter shared by every session that asks for the same host and
+    pool settings, so that sessions for different providers (or many RSS feeds
+    on one CDN) draw on a single pool of connections.
+    """
+    key = (host, tuple(sorted(kwargs.items())))
+    with SHARED_ADAPTERS_LOCK:
+        adapter = SHARED_ADAPTERS.get(key)
+        if adapter is None:
+            adapter = SHARED_ADAPTERS[key] = KeepAliveHTTPAdapter(**kwargs)
+    return adapter
+
+def mount_adapters(session, pool_config=None, replay_config=None):
+    """
+    Mount connection pooling adapters on a requests.Session according to the
+    `pool` section of a provider's session config, e.g.:
+
+        pool:
+            maxsize: 20
+            keepalive_idle: 60
+            shared: true
+            hosts:
+                feeds.example.com: 40
+
+    If a `replay` section is given, each adapter is wrapped in a
+    RecordReplayAdapter with those settings, e.g.:
+
+        replay:
+            mode: replay
+            path: ~/streamglob-fixtures
+            latency: 0.05
+    """
+    pool_config = pool_config or {}
+    replay_config = dict(replay_config or {})
+    if replay_config.get("path"):
+        replay_config["path"] = os.path.expanduser(replay_config["path"])
+    shared = pool_config.get("shared", False)
+    adapter_kwargs = dict(
+        pool_maxsize = pool_config.get("maxsize", DEFAULT_POOL_MAXSIZE),
+        keepalive = pool_config.get("keepalive", True),
+        keepalive_idle = pool_config.get("keepalive_idle")
+    )
+
+    def make_adapter(host=None, **kwargs):
+        kwargs = dict(adapter_kwargs, **kwargs)
+        if shared:
+            adapter = shared_adapter(host, **kwargs)
+        else:
+            adapter = KeepAliveHTTPAdapter(**kwargs)
+        if replay_config:
+            adapter = RecordReplayAdapter(adapter, **replay_config)
+        return adapter
+
+    adapter = make_adapter()
+    for prefix in ["http://", "https://"]:
+        session.mount(prefix, adapter)
+
+    for host, maxsize in (pool_config.get("hosts") or {}).items():
+        adapter = make_adapter(host, pool_maxsize=maxsize)
+        for scheme in ["http", "https"]:
+            session.mount(f"{scheme}://{host}/", adapter)
+
+def adapter_stats(session):
+    """
+    Connection counters summed over the distinct pooling adapters mounted on a
+    requests.Session.
+    """
+    stats = AttrDict(pools=0, connections=0, requests=0, reused=0)
+    adapters = {id(a): a for a in session.adapters.values()}.values()
+    for adapter in adapters:
+        adapter = getattr(adapter, "adapter", adapter)
+        if not isinstance(adapter, KeepAliveHTTPAdapter):
+            continue
+        for k, v in adapter.stats.items():
+            stats[k] += v
+    return stats
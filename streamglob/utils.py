@@ -1,5 +1,9 @@
+import os
 import itertools
 import re
+import tempfile
+from contextlib import contextmanager
+import bitmath
 import mistune
 import html2text
 import html.parser
@@ -87,6 +91,42 @@ def format_timedelta(td):
     return (f"{'%sd' % days if days else ''}"
             f"{hours:02}:{minutes:02}:{seconds:02}")
 
+def fsync_dir(path):
+    # directories can't be opened (or synced) on Windows, where renames are
+    # durable anyway
+    if not hasattr(os, "O_DIRECTORY"):
+        return
+    fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+@contextmanager
+def atomic_file(path):
+    """
+    Yield a temporary filename in the same directory as `path`, which replaces
+    `path` once the block finishes without an exception.  The new contents
+    and the rename are both synced to disk, so after a crash `path` holds
+    either the old contents or the new ones.
+    """
+    directory = os.path.dirname(path) or "."
+    fd, tmp = tempfile.mkstemp(
+        dir=directory,
+        prefix=f".{os.path.basename(path)}.",
+        suffix=".tmp"
+    )
+    os.close(fd)
+    try:
+        yield tmp
+        with open(tmp, "r+b") as f:
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+        fsync_dir(directory)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
 def format_str_truncated(n, s):
     return s[:n-1] + u"\u2026" if len(s) >= n else s
 
@@ -235,11 +275,22 @@ def html_to_urwid_text_markup(html, excludes=[]):
 
 
 
+def parse_size(value):
+    """
+    Convert a size from the config file (either a number of bytes or a string
+    like "32MB") to a number of bytes.
+    """
+    if value is None or isinstance(value, int):
+        return value
+    return int(bitmath.parse_string(value).bytes)
+
 __all__ = [
     "classproperty",
     "valid_date",
     "format_datetime",
     "format_timedelta",
+    "atomic_file",
+    "parse_size",
     "strip_emoji",
     "strip_html",
     "html_to_urwid_text_markup"
@@ -0,0 +1,178 @@
+import logging
+logger = logging.getLogger(__name__)
+
+import time
+import queue
+import atexit
+import threading
+from concurrent.futures import Future
+
+from orderedattrdict import AttrDict
+from pony.orm import db_session
+
+class DatabaseWriter(object):
+    """
+    Runs database writes on a single thread.  Writes are queued from any thread
+    with submit(), and whatever has accumulated in the queue is committed in
+    one transaction, so many small writes become a few large commits and
+    writers never contend with each other for the database lock.  Reads are
+    unaffected and can still happen concurrently on any thread.
+
+    Each write is a function called inside the writer's db_session.  It should
+    return plain values rather than entity objects, which can't be used once
+    the writer's session has ended.  If a batch fails, its writes are retried
+    one at a time so that a single bad write doesn't take the others with it.
+    """
+
+    MAX_BATCH_SIZE = 200
+    # how long to wait for more writes to join a batch
+    BATCH_DELAY = 0.05
+
+    def __init__(self, max_batch_size=None, batch_delay=None):
+        self.max_batch_size = max_batch_size or self.MAX_BATCH_SIZE
+        self.batch_delay = (
+            batch_delay if batch_delay is not None else self.BATCH_DELAY
+        )
+        self.queue = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+        self.batches = 0
+        self.writes = 0
+        self.failures = 0
+        self.commit_time = 0
+        self.max_commit_time = 0
+        self.last_commit_time = None
+        atexit.register(self.stop)
+
+    def configure(self, cfg):
+        cfg = cfg or {}
+        self.max_batch_size = cfg.get("max_batch_size", self.max_batch_size)
+        self.batch_delay = cfg.get("batch_delay", self.batch_delay)
+
+    @property
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self):
+        with self.lock:
+            if self.running:
+                return
+            self.thread = threading.Thread(
+                target=self.run, name="DatabaseWriter", daemon=True
+            )
+            self.thread.start()
+
+    def stop(self, timeout=None):
+        """
+        Commit everything queued so far and stop the writer thread.
+        """
+        if not self.running:
+            return
+        self.queue.put(None)
+        self.thread.join(timeout)
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        Queue fn(*args, **kwargs) to be run in a write transaction.  Returns a
+        Future for its result, which is set once the transaction commits.
+        """
+        future = Future()
+        if threading.current_thread() is self.thread:
+            # already inside a write, e.g. one write queueing another
+            future.set_running_or_notify_cancel()
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except Exception as e:
+                future.set_exception(e)
+            return future
+        self.start()
+        self.queue.put((future, fn, args, kwargs))
+        return future
+
+    def write(self, fn, *args, **kwargs):
+        """
+        Like submit(), but wait for the write to be committed and return its
+        result.
+        """
+        return self.submit(fn, *args, **kwargs).result()
+
+    def flush(self):
+        """
+        Wait until everything queued so far has been committed.
+        """
+        if self.running:
+            self.write(lambda: None)
+
+    def next_batch(self):
+        op = self.queue.get()
+        if op is None:
+            return None
+        batch = [op]
+        deadline = time.monotonic() + self.batch_delay
+        while len(batch) < self.max_batch_size:
+            try:
+                op = self.queue.get(
+                    timeout=max(0, deadline - time.monotonic())
+                )
+            except queue.Empty:
+                break
+            if op is None:
+                # finish this batch before stopping
+                self.queue.put(None)
+                break
+            batch.append(op)
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            if batch is None:
+                break
+            batch = [
+                op for op in batch
+                if op[0].set_running_or_notify_cancel()
+            ]
+            if batch:
+                self.commit(batch)
+
+    def commit(self, batch):
+        start = time.monotonic()
+        try:
+            with db_session:
+                results = [fn(*args, **kwargs) for (_, fn, args, kwargs) in batch]
+        except Exception as e:
+            if len(batch) == 1:
+                self.failures += 1
+                logger.warning(f"database write failed: {e}")
+                batch[0][0].set_exception(e)
+                return
+            logger.debug(f"retrying batch of {len(batch)} writes individually")
+            for op in batch:
+                self.commit([op])
+            return
+
+        elapsed = time.monotonic() - start
+        self.batches += 1
+        self.writes += len(batch)
+        self.commit_time += elapsed
+        self.last_commit_time = elapsed
+        self.max_commit_time = max(self.max_commit_time, elapsed)
+        for (future, _, _, _), result in zip(batch, results):
+            future.set_result(result)
+
+    @property
+    def stats(self):
+        return AttrDict(
+            queued = self.queue.qsize(),
+            batches = self.batches,
+            writes = self.writes,
+            failures = self.failures,
+            last_commit_time = self.last_commit_time,
+            avg_commit_time = (
+                self.commit_time / self.batches if self.batches else None
+            ),
+            max_commit_time = self.max_commit_time,
+        )
+
+
+db_writer = DatabaseWriter()
@@ -0,0 +1,65 @@
+import os
+import time
+import tempfile
+import threading
+
+import requests
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+
+from streamglob import config
+from streamglob import model
+
+TEST_DIR = tempfile.mkdtemp(prefix="streamglob-test-")
+config.CONFIG_DIR = TEST_DIR
+
+def init_db():
+    """
+    Bind the model to a scratch database.  Pony can only bind once per
+    process, so every test module shares it.
+    """
+    if model.db.provider is None:
+        model.DB_FILE = os.path.join(TEST_DIR, "streamglob.sqlite")
+        model.init()
+
+
+class FakeAdapter(BaseAdapter):
+    """
+    Transport adapter that answers every request with the same response,
+    optionally after a delay, and keeps the requests it was sent and the
+    timeouts they were sent with.  Requests
+    with an If-None-Match header matching `etag` get a 304.
+    """
+
+    def __init__(self, body=b"ok", status=200, etag=None, delay=0,
+                 headers=None):
+        super().__init__()
+        self.body = body
+        self.headers = headers or {}
+        self.status = status
+        self.etag = etag
+        self.delay = delay
+        self.requests = []
+        self.timeouts = []
+        self.lock = threading.Lock()
+
+    def send(self, request, **kwargs):
+        with self.lock:
+            self.requests.append(request)
+            self.timeouts.append(kwargs.get("timeout"))
+        if self.delay:
+            time.sleep(self.delay)
+        response = requests.Response()
+        response.status_code = self.status
+        response.headers = CaseInsensitiveDict(self.headers)
+        if self.etag:
+            response.headers["ETag"] = self.etag
+            if request.headers.get("If-None-Match") == self.etag:
+                response.status_code = 304
+        response.url = request.url
+        response.request = request
+        response._content = b"" if response.status_code == 304 else self.body
+        return response
+
+    def close(self):
+        pass
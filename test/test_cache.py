@@ -0,0 +1,122 @@
+import unittest
+from datetime import datetime, timedelta
+
+import requests
+from pony.orm import select
+from requests.structures import CaseInsensitiveDict
+
+from streamglob import cache
+from streamglob import model
+from streamglob import writer
+
+from . import init_db
+
+def make_response(url, body=b"ok"):
+    response = requests.Response()
+    response.status_code = 200
+    response.headers = CaseInsensitiveDict()
+    response.url = url
+    response._content = body
+    return response
+
+def age_entries(seconds):
+    writer.db_writer.flush()
+    with model.db_session:
+        for e in model.CacheEntry.select():
+            e.last_seen -= timedelta(seconds=seconds)
+            if e.keep_until:
+                e.keep_until -= timedelta(seconds=seconds)
+
+
+class TestCacheKey(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = cache.HTTPCache()
+
+    def test_key_includes_every_header(self):
+        self.assertNotEqual(
+            self.cache.key("GET", "http://example.test/", headers={"X-Api-Key": "a"}),
+            self.cache.key("GET", "http://example.test/", headers={"X-Api-Key": "b"})
+        )
+        self.assertNotEqual(
+            self.cache.key("GET", "http://example.test/"),
+            self.cache.key("GET", "http://example.test/", headers={"Origin": "x"})
+        )
+
+    def test_key_ignores_header_case_and_order(self):
+        self.assertEqual(
+            self.cache.key("GET", "http://example.test/",
+                           headers={"Accept": "a", "Origin": "b"}),
+            self.cache.key("GET", "http://example.test/",
+                           headers={"origin": "b", "accept": "a"})
+        )
+
+    def test_key_ignores_validators(self):
+        self.assertEqual(
+            self.cache.key("GET", "http://example.test/"),
+            self.cache.key("GET", "http://example.test/",
+                           headers={"If-None-Match": "x"})
+        )
+
+    def test_key_includes_options(self):
+        self.assertNotEqual(
+            self.cache.key("GET", "http://example.test/", allow_redirects=True),
+            self.cache.key("GET", "http://example.test/", allow_redirects=False)
+        )
+
+
+class TestMemoryCache(unittest.TestCase):
+
+    def entry(self, body):
+        return cache.CachedResponse(
+            key="a", url="http://example.test/a", status=200, headers={},
+            body=body
+        )
+
+    def test_oversized_entry_replaces_old_one(self):
+        memory = cache.MemoryCache(max_size=10)
+        memory.put(self.entry(b"old"))
+        memory.put(self.entry(b"x" * 20))
+        self.assertIsNone(memory.get("a"))
+        self.assertEqual(memory.size, 0)
+
+
+class TestEviction(unittest.TestCase):
+
+    def setUp(self):
+        init_db()
+        writer.db_writer.flush()
+        cache.http_cache.memory.clear()
+        with model.db_session:
+            model.CacheEntry.select().delete(bulk=True)
+        self.evictor = cache.CacheEvictor()
+
+    def keys(self):
+        with model.db_session:
+            return set(select(e.key for e in model.CacheEntry))
+
+    def test_expired_entries_are_evicted(self):
+        cache.http_cache.put("a", make_response("http://example.test/a"))
+        age_entries(self.evictor.max_age + 60)
+        self.assertEqual(self.evictor.evict_expired(100), 1)
+        self.assertEqual(self.keys(), set())
+
+    def test_stale_window_outlives_max_age(self):
+        duration = model.CACHE_DURATION_LONG
+        cache.http_cache.put(
+            "a", make_response("http://example.test/a"), keep=duration * 2
+        )
+        cache.http_cache.put(
+            "b", make_response("http://example.test/b"), keep=duration
+        )
+        # past the evictor's max age, but inside a's stale window
+        age_entries(duration + 60)
+        self.assertEqual(self.evictor.evict_expired(100), 1)
+        self.assertEqual(self.keys(), {"a"})
+        age_entries(duration)
+        self.assertEqual(self.evictor.evict_expired(100), 1)
+        self.assertEqual(self.keys(), set())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,73 @@
+import unittest
+from datetime import datetime
+
+from streamglob import model
+
+try:
+    from streamglob.providers import feed
+    from streamglob.providers import widgets
+except ImportError:
+    # the providers need the UI's dependencies
+    feed = None
+
+
+class FakeTable(list):
+    """
+    Stands in for a CachedFeedProviderDataTable, with rows already loaded.
+    """
+
+    def __init__(self, rows, provider):
+        super().__init__(rows)
+        self.provider = provider
+
+    def query_cursor(self, offset):
+        return feed.CachedFeedProviderDataTable.query_cursor(self, offset)
+
+
+class FakeProvider(object):
+
+    def __init__(self):
+        self.calls = []
+
+    def listings(self, *args, **kwargs):
+        self.calls.append(kwargs)
+        return []
+
+
+class Row(object):
+
+    def __init__(self, data):
+        self.data = data
+
+
+@unittest.skipIf(feed is None, "streamglob.providers can't be imported")
+class TestQueryCursor(unittest.TestCase):
+
+    def setUp(self):
+        self.provider = FakeProvider()
+        self.last = model.MediaListing(
+            "test", _attrs=dict(created=datetime.now(), media_item_id=1)
+        )
+        self.table = FakeTable([Row(self.last)], self.provider)
+
+    def query(self, **kwargs):
+        list(widgets.ProviderDataTable.query(self.table, **kwargs))
+        return self.provider.calls[-1]
+
+    def test_last_listing_is_the_cursor(self):
+        kwargs = self.query(offset=1, cursor=datetime.now())
+        self.assertIs(kwargs["cursor"], self.last)
+
+    def test_panwid_cursor_is_dropped(self):
+        # e.g. load_all(), which doesn't continue from the last row
+        kwargs = self.query(offset=10, cursor=datetime.now())
+        self.assertNotIn("cursor", kwargs)
+
+    def test_seek_rejects_other_cursors(self):
+        self.assertIsNone(
+            feed.CachedFeedProvider.seek(None, None, datetime.now())
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,294 @@
+import unittest
+from datetime import datetime, timedelta
+
+from orderedattrdict import AttrDict
+from pony.orm import db_session, select, count, desc
+
+from streamglob import model
+
+from . import init_db
+
+
+class FeedTestCase(unittest.TestCase):
+
+    def setUp(self):
+        init_db()
+        with db_session:
+            model.MediaChannel.select().delete()
+            feed = model.MediaFeed(
+                provider_id="test", name=self.id(), locator=self.id()
+            )
+        self.feed_id = feed.channel_id
+
+    def add_items(self, n, age=0, **kwargs):
+        with db_session:
+            feed = model.MediaFeed[self.feed_id]
+            for i in range(n):
+                model.MediaItem(
+                    feed=feed, guid=f"{age}-{i}", title=f"item {i}",
+                    content=[],
+                    created=datetime.now() - timedelta(days=age, seconds=i),
+                    **kwargs
+                )
+
+
+class TestBulkUpsert(FeedTestCase):
+
+    def upsert(self, rows):
+        return model.MediaItem.bulk_upsert(
+            ["feed", "guid"],
+            [dict(row, feed=self.feed_id) for row in rows]
+        )
+
+    def items(self):
+        with db_session:
+            return dict(
+                (i.guid, (i.title, i.description))
+                for i in model.MediaFeed[self.feed_id].items
+            )
+
+    def test_insert_and_update(self):
+        first = self.upsert([
+            dict(guid="a", title="a", content=[]),
+            dict(guid="b", title="b", content=[]),
+        ])
+        self.assertEqual(len(first.inserted), 2)
+        self.assertEqual(first.updated, [])
+        second = self.upsert([
+            dict(guid="b", title="B", content=[]),
+            dict(guid="c", title="c", content=[]),
+        ])
+        self.assertEqual(len(second.inserted), 1)
+        self.assertEqual(second.updated, first.inserted[1:])
+        self.assertEqual(
+            self.items(),
+            {"a": ("a", ""), "b": ("B", ""), "c": ("c", "")}
+        )
+
+    def test_missing_values_are_not_overwritten(self):
+        self.upsert([
+            dict(guid="a", title="a", description="first", content=[]),
+        ])
+        # a row with a description in the same batch mustn't cause a's to be
+        # reset to the default
+        self.upsert([
+            dict(guid="a", title="A", content=[]),
+            dict(guid="b", title="b", description="second", content=[]),
+        ])
+        self.assertEqual(
+            self.items(),
+            {"a": ("A", "first"), "b": ("b", "second")}
+        )
+
+    def test_without_returning(self):
+        supported = model.SQLITE_HAS_RETURNING
+        model.SQLITE_HAS_RETURNING = False
+        try:
+            self.test_insert_and_update()
+            with db_session:
+                model.MediaItem.select().delete(bulk=True)
+            self.test_missing_values_are_not_overwritten()
+        finally:
+            model.SQLITE_HAS_RETURNING = supported
+
+
+class TestKeysetPagination(FeedTestCase):
+    """
+    Paging with MediaItem.seek() from the last listing of each page must give
+    the same rows as paging with an offset, including across ties in the
+    sort column.
+    """
+
+    PAGE_SIZE = 4
+
+    def setUp(self):
+        super().setUp()
+        created = datetime.now().replace(microsecond=0)
+        with db_session:
+            feed = model.MediaFeed[self.feed_id]
+            for i in range(15):
+                model.MediaItem(
+                    feed=feed, guid=str(i), title=f"item {i}", content=[],
+                    # three items share each time
+                    created=created - timedelta(minutes=i // 3)
+                )
+
+    def query(self, sort_desc):
+        query = model.MediaItem.select(
+            lambda i: i.feed.channel_id == self.feed_id
+        )
+        if sort_desc:
+            return query.order_by(
+                lambda i: (desc(i.created), desc(i.media_item_id))
+            )
+        return query.order_by(lambda i: (i.created, i.media_item_id))
+
+    def pages_by_offset(self, sort_desc):
+        with db_session:
+            query = self.query(sort_desc)
+            return [
+                [i.media_item_id
+                 for i in query[offset:offset+self.PAGE_SIZE]]
+                for offset in range(0, query.count(), self.PAGE_SIZE)
+            ]
+
+    def pages_by_cursor(self, sort_desc):
+        pages = []
+        cursor = None
+        with db_session:
+            while True:
+                query = self.query(sort_desc)
+                if cursor:
+                    query = model.MediaItem.seek(
+                        query, "created", sort_desc, cursor
+                    )
+                page = query[:self.PAGE_SIZE]
+                if not page:
+                    return pages
+                pages.append([i.media_item_id for i in page])
+                cursor = model.MediaListing(
+                    "test", _attrs=AttrDict(page[-1].to_dict())
+                )
+
+    def test_cursor_pages_match_offset_pages(self):
+        for sort_desc in [True, False]:
+            pages = self.pages_by_offset(sort_desc)
+            self.assertEqual(len(pages), 4)
+            self.assertEqual(self.pages_by_cursor(sort_desc), pages)
+
+    def test_only_listings_are_cursors(self):
+        with db_session:
+            query = self.query(True)
+            # e.g. the raw sort value panwid passes as its own cursor
+            self.assertIsNone(
+                model.MediaItem.seek(query, "created", True, datetime.now())
+            )
+            self.assertIsNone(
+                model.MediaItem.seek(
+                    query, "created", True, model.MediaListing("test")
+                )
+            )
+
+
+class TestPurge(FeedTestCase):
+
+    def guids(self, entity):
+        with db_session:
+            return set(
+                select(i.guid for i in entity if i.feed.channel_id == self.feed_id)
+            )
+
+    def purge(self, **kwargs):
+        with db_session:
+            return model.MediaFeed[self.feed_id].purge(**kwargs)
+
+    def test_old_items_are_archived(self):
+        self.add_items(3)
+        self.add_items(3, age=100)
+        self.assertEqual(self.purge(min_items=2, max_items=10, max_age=90), 3)
+        self.assertEqual(self.guids(model.MediaItem), {"0-0", "0-1", "0-2"})
+        self.assertEqual(
+            self.guids(model.MediaItemArchive), {"100-0", "100-1", "100-2"}
+        )
+
+    def test_min_and_max_items(self):
+        self.add_items(2, age=100)
+        # too few items to purge any of them
+        self.assertEqual(self.purge(min_items=2, max_items=10, max_age=90), 0)
+        self.add_items(10)
+        # the oldest two are both too old and over the limit
+        self.assertEqual(self.purge(min_items=2, max_items=10, max_age=90), 2)
+        self.assertEqual(len(self.guids(model.MediaItem)), 10)
+
+    def test_archived_items_are_still_recognized(self):
+        self.add_items(3, age=100)
+        self.purge(min_items=0, max_items=10, max_age=90)
+        self.assertEqual(self.guids(model.MediaItem), set())
+        with db_session:
+            self.assertEqual(
+                model.MediaFeed[self.feed_id].existing_guids(["100-0", "new"]),
+                {"100-0"}
+            )
+
+
+class TestFeedCounts(FeedTestCase):
+
+    def assertCounts(self, total, unread, not_downloaded):
+        counts = dict(
+            (status, model.MediaFeedCounts.count([self.feed_id], status))
+            for status in model.MediaFeedCounts.STATUSES
+        )
+        self.assertEqual(
+            counts,
+            dict(all=total, unread=unread, not_downloaded=not_downloaded)
+        )
+        # and they agree with the items themselves
+        with db_session:
+            items = select(
+                i for i in model.MediaItem if i.feed.channel_id == self.feed_id
+            )
+            self.assertEqual(
+                (items.count(),
+                 items.filter(lambda i: i.read is None).count(),
+                 items.filter(lambda i: i.downloaded is None).count()),
+                (total, unread, not_downloaded)
+            )
+
+    def test_counts_follow_changes(self):
+        self.add_items(4)
+        self.add_items(1, age=1, downloaded=datetime.now())
+        self.assertCounts(5, 5, 4)
+
+        with db_session:
+            item_id = select(i.media_item_id for i in model.MediaItem).first()
+            model.MediaItem.set_read_states({item_id: datetime.now()})
+        self.assertCounts(5, 4, 4)
+
+        with db_session:
+            model.MediaItem.set_read_states({item_id: None})
+            model.MediaItem[item_id].delete()
+        self.assertCounts(4, 4, 3)
+
+        with db_session:
+            model.MediaFeed[self.feed_id].mark_all_items_read()
+        self.assertCounts(4, 0, 3)
+
+    def test_counts_follow_bulk_writes(self):
+        model.MediaItem.bulk_upsert(
+            ["feed", "guid"],
+            [dict(feed=self.feed_id, guid=str(n), title=str(n), content=[])
+             for n in range(3)]
+        )
+        self.assertCounts(3, 3, 3)
+        self.add_items(3, age=100)
+        with db_session:
+            model.MediaFeed[self.feed_id].purge(
+                min_items=0, max_items=10, max_age=90
+            )
+        self.assertCounts(3, 3, 3)
+
+    def test_counts_removed_with_feed(self):
+        self.add_items(2)
+        with db_session:
+            model.MediaFeed[self.feed_id].delete()
+        with db_session:
+            self.assertIsNone(model.MediaFeedCounts.get(feed=self.feed_id))
+
+
+class TestMediaSourceContent(unittest.TestCase):
+
+    def test_missing_sources_are_skipped(self):
+        sources = [
+            model.MediaSource(provider_id="test", url="http://example.test/a"),
+            None,
+            model.MediaSource(provider_id="test", url="http://example.test/b"),
+        ]
+        content = model.MediaSource.to_content(sources)
+        self.assertEqual(
+            [s.url for s in model.MediaSource.from_content(content)],
+            ["http://example.test/a", "http://example.test/b"]
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,286 @@
+import os
+import gc
+import weakref
+import time
+import asyncio
+import threading
+import unittest
+from unittest import mock
+from email.utils import format_datetime
+from datetime import datetime, timedelta, timezone
+from http.cookiejar import LWPCookieJar
+
+import requests
+
+from streamglob import model
+from streamglob import writer
+
+from . import init_db, FakeAdapter
+
+try:
+    from streamglob import cache
+    from streamglob import session
+except ImportError:
+    # session pulls in the whole application's dependencies
+    session = None
+
+URL = "http://example.test/feed"
+
+
+class SessionTestCase(unittest.TestCase):
+    """
+    Starts each test with an empty response cache and a session whose
+    requests to example.test go to a FakeAdapter made with ADAPTER_ARGS.
+    """
+
+    ADAPTER_ARGS = {}
+
+    def setUp(self):
+        init_db()
+        writer.db_writer.flush()
+        cache.http_cache.memory.clear()
+        with model.db_session:
+            model.CacheEntry.select().delete(bulk=True)
+        self.adapter = FakeAdapter(**self.ADAPTER_ARGS)
+        self.session = session.StreamSession("test")
+        self.session.session.mount("http://example.test/", self.adapter)
+
+
+@unittest.skipIf(session is None, "streamglob.session can't be imported")
+class TestTokenBucket(unittest.TestCase):
+
+    def test_waits_are_counted(self):
+        with mock.patch.object(session.time, "monotonic", return_value=100.0), \
+             mock.patch.object(session.time, "sleep") as sleep:
+            bucket = session.TokenBucket(rate=2, burst=2)
+            # the burst is free
+            self.assertEqual([bucket.acquire() for n in range(2)], [0, 0])
+            # then each request waits for another token
+            self.assertEqual(bucket.acquire(), 0.5)
+            self.assertEqual(bucket.acquire(), 1.0)
+        self.assertEqual(
+            [c.args[0] for c in sleep.call_args_list], [0.5, 1.0]
+        )
+        self.assertEqual(bucket.waits, 2)
+        self.assertEqual(bucket.wait_time, 1.5)
+
+    def test_tokens_refill(self):
+        with mock.patch.object(session.time, "monotonic") as monotonic, \
+             mock.patch.object(session.time, "sleep"):
+            monotonic.return_value = 100.0
+            bucket = session.TokenBucket(rate=2, burst=2)
+            bucket.acquire()
+            bucket.acquire()
+            monotonic.return_value = 101.0
+            self.assertEqual(bucket.acquire(), 0)
+        self.assertEqual(bucket.waits, 0)
+
+
+@unittest.skipIf(session is None, "streamglob.session can't be imported")
+class TestRetryPolicy(unittest.TestCase):
+
+    def response(self, status=503, **headers):
+        response = requests.Response()
+        response.status_code = status
+        response.headers = requests.structures.CaseInsensitiveDict(headers)
+        return response
+
+    def test_backoff_schedule(self):
+        policy = session.RetryPolicy(backoff=0.5, max_backoff=60)
+        self.assertEqual(
+            [policy.delay(attempt) for attempt in range(4)],
+            [0.5, 1.0, 2.0, 4.0]
+        )
+
+    def test_backoff_is_capped(self):
+        policy = session.RetryPolicy(backoff=1, max_backoff=10)
+        self.assertEqual(policy.delay(10), 10)
+        self.assertEqual(
+            policy.delay(0, self.response(**{"Retry-After": "3600"})), 10
+        )
+
+    def test_retry_after_seconds(self):
+        policy = session.RetryPolicy()
+        self.assertEqual(
+            policy.delay(0, self.response(**{"Retry-After": "7"})), 7
+        )
+
+    def test_retry_after_date(self):
+        policy = session.RetryPolicy()
+        when = datetime.now(timezone.utc) + timedelta(seconds=30)
+        delay = policy.delay(
+            0, self.response(**{"Retry-After": format_datetime(when, usegmt=True)})
+        )
+        self.assertTrue(25 <= delay <= 30, delay)
+        # a date in the past means no wait
+        when = datetime.now(timezone.utc) - timedelta(seconds=30)
+        self.assertEqual(
+            policy.delay(
+                0, self.response(**{"Retry-After": format_datetime(when, usegmt=True)})
+            ),
+            0
+        )
+
+    def test_unparseable_retry_after_falls_back_to_backoff(self):
+        policy = session.RetryPolicy(backoff=0.5)
+        self.assertEqual(
+            policy.delay(1, self.response(**{"Retry-After": "soon"})), 1.0
+        )
+
+    def test_should_retry(self):
+        policy = session.RetryPolicy(max_retries=2)
+        self.assertTrue(policy.should_retry("get", 0))
+        self.assertTrue(policy.should_retry("get", 1, self.response(503)))
+        self.assertFalse(policy.should_retry("get", 2))
+        self.assertFalse(policy.should_retry("get", 0, self.response(404)))
+        self.assertFalse(policy.should_retry("post", 0))
+
+
+@unittest.skipIf(session is None, "streamglob.session can't be imported")
+class TestCachePolicy(SessionTestCase):
+
+    def test_nested_policies(self):
+        with self.session.cache_responses(100):
+            with self.session.cache_responses(5, stale_while_revalidate=10):
+                self.assertEqual(self.session.cache_policy.duration, 5)
+                self.assertEqual(self.session.cache_policy.max_stale, 10)
+            self.assertEqual(self.session.cache_policy.duration, 100)
+        self.assertFalse(self.session.cache_policy)
+
+    def test_policy_is_per_thread(self):
+        policies = []
+        thread = threading.Thread(
+            target=lambda: policies.append(self.session.cache_policy)
+        )
+        with self.session.cache_responses(100):
+            thread.start()
+            thread.join()
+        self.assertEqual(policies, [False])
+
+    def test_arequest_uses_policy_when_called(self):
+
+        async def run():
+            with self.session.cache_responses(100):
+                pending = self.session.aget(URL)
+            # awaited outside the block, but still cached
+            await pending
+            # no policy, so not read from the cache
+            await self.session.aget(URL)
+            with self.session.cache_responses(100):
+                response = await self.session.aget(URL)
+            return response
+
+        response = asyncio.run(run())
+        self.assertEqual(len(self.adapter.requests), 2)
+        self.assertTrue(getattr(response, "from_cache", False))
+
+
+@unittest.skipIf(session is None, "streamglob.session can't be imported")
+class TestStaleWhileRevalidate(SessionTestCase):
+
+    ADAPTER_ARGS = dict(etag='"v1"')
+
+    def get(self):
+        with self.session.cache_responses_long(
+                stale_while_revalidate=model.CACHE_DURATION_LONG
+        ):
+            return self.session.get(URL)
+
+    def test_stale_long_cache_entry_is_served_and_revalidated(self):
+        self.get()
+        writer.db_writer.flush()
+        # older than the evictor keeps ordinary entries, but still within
+        # the stale window
+        age = model.CACHE_DURATION_LONG + 60*60*24
+        with model.db_session:
+            for e in model.CacheEntry.select():
+                e.last_seen -= timedelta(seconds=age)
+        cache.http_cache.memory.clear()
+        self.assertEqual(cache.CacheEvictor().evict_expired(100), 0)
+
+        response = self.get()
+        self.assertTrue(response.from_cache)
+        self.assertEqual(response.content, b"ok")
+        self.assertEqual(self.session.stale_served, 1)
+
+        self.session.executor.shutdown(wait=True)
+        writer.db_writer.flush()
+        self.assertEqual(self.session.revalidations, 1)
+        self.assertEqual(len(self.adapter.requests), 2)
+        self.assertEqual(
+            self.adapter.requests[1].headers.get("If-None-Match"), '"v1"'
+        )
+        with model.db_session:
+            entry = model.CacheEntry.select().first()
+            self.assertLess(datetime.now() - entry.last_seen, timedelta(minutes=1))
+
+
+@unittest.skipIf(session is None, "streamglob.session can't be imported")
+class TestCoalescing(SessionTestCase):
+
+    ADAPTER_ARGS = dict(delay=0.2)
+
+    def fetch_all(self, requests):
+        async def run():
+            return await asyncio.gather(*[
+                self.session.aget(URL, **kwargs) for kwargs in requests
+            ])
+        return asyncio.run(run())
+
+    def test_identical_requests_share_a_fetch(self):
+        responses = self.fetch_all([{}, {}, {}])
+        self.assertEqual(len(self.adapter.requests), 1)
+        self.assertEqual([r.content for r in responses], [b"ok"] * 3)
+
+    def test_different_headers_are_not_shared(self):
+        self.fetch_all([
+            dict(headers={"x-api-key": "a"}),
+            dict(headers={"x-api-key": "b"}),
+        ])
+        self.assertEqual(len(self.adapter.requests), 2)
+
+    def test_requests_with_bodies_are_not_shared(self):
+        self.fetch_all([dict(json={"a": 1}), dict(json={"a": 2})])
+        self.assertEqual(len(self.adapter.requests), 2)
+
+
+@unittest.skipIf(session is None, "streamglob.session can't be imported")
+class TestTimeout(SessionTestCase):
+
+    def test_requests_have_a_default_timeout(self):
+        self.session.get(URL)
+        self.session.get(URL, timeout=5)
+        self.assertEqual(
+            self.adapter.timeouts, [session.StreamSession.REQUEST_TIMEOUT, 5]
+        )
+
+
+@unittest.skipIf(session is None, "streamglob.session can't be imported")
+class TestSave(unittest.TestCase):
+
+    def test_flush_writes_cookies(self):
+        s = session.StreamSession("test")
+        s.cookies.set_cookie(
+            requests.cookies.create_cookie(
+                "token", "abc", domain="example.test",
+                expires=int(time.time()) + 3600, discard=False
+            )
+        )
+        s.save()
+        s.flush()
+        cookies = LWPCookieJar()
+        cookies.load(s.COOKIES_FILE, ignore_discard=True)
+        self.assertEqual([c.value for c in cookies], ["abc"])
+        os.remove(s.COOKIES_FILE)
+
+    def test_sessions_are_not_kept_alive(self):
+        s = session.StreamSession("test")
+        self.assertIn(s, session.SESSIONS)
+        ref = weakref.ref(s)
+        del s
+        gc.collect()
+        self.assertIsNone(ref())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,81 @@
+import os
+import time
+import shutil
+import tempfile
+import unittest
+
+import requests
+
+from streamglob import transport
+
+from . import FakeAdapter
+
+URL = "http://example.test/feed"
+
+
+class TestRecordReplay(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix="streamglob-fixtures-")
+        self.addCleanup(shutil.rmtree, self.path)
+        self.adapter = FakeAdapter(
+            body=b"<rss/>", headers={"Content-Encoding": "gzip"}
+        )
+
+    def session(self, mode, **kwargs):
+        session = requests.Session()
+        session.mount(
+            "http://", transport.RecordReplayAdapter(
+                self.adapter, mode=mode, path=self.path, **kwargs
+            )
+        )
+        return session
+
+    def fixtures(self):
+        return [
+            name
+            for (_, _, names) in os.walk(self.path)
+            for name in names
+        ]
+
+    def test_round_trip(self):
+        recorded = self.session("record").get(URL)
+        self.assertEqual(recorded.content, b"<rss/>")
+        self.assertEqual(len(self.fixtures()), 1)
+
+        replayed = self.session("replay").get(URL)
+        self.assertEqual(len(self.adapter.requests), 1)
+        self.assertEqual(replayed.status_code, 200)
+        self.assertEqual(replayed.content, b"<rss/>")
+        # the recorded body was already decoded
+        self.assertNotIn("Content-Encoding", replayed.headers)
+
+    def test_fixtures_are_keyed_by_method_url_and_body(self):
+        session = self.session("record")
+        session.get(URL)
+        session.get(URL)
+        session.post(URL, data=b"a")
+        session.post(URL, data=b"b")
+        session.get(URL + "?page=2")
+        self.assertEqual(len(self.fixtures()), 4)
+
+        replay = self.session("replay")
+        self.assertEqual(replay.post(URL, data=b"b").content, b"<rss/>")
+        with self.assertRaises(requests.exceptions.ConnectionError):
+            replay.post(URL, data=b"c")
+
+    def test_missing_fixture_is_a_connection_error(self):
+        with self.assertRaises(requests.exceptions.ConnectionError):
+            self.session("replay").get(URL)
+        self.assertEqual(self.adapter.requests, [])
+
+    def test_latency(self):
+        self.session("record").get(URL)
+        start = time.monotonic()
+        response = self.session("replay", latency=0.2).get(URL)
+        self.assertGreaterEqual(time.monotonic() - start, 0.2)
+        self.assertGreaterEqual(response.elapsed.total_seconds(), 0.2)
+
+
+if __name__ == "__main__":
+    unittest.main()
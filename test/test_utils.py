@@ -0,0 +1,38 @@
+import os
+import tempfile
+import unittest
+
+from streamglob import utils
+
+
+class TestAtomicFile(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "state")
+        with open(self.path, "w") as f:
+            f.write("old")
+
+    def read(self):
+        with open(self.path) as f:
+            return f.read()
+
+    def test_replaces_file(self):
+        with utils.atomic_file(self.path) as tmp:
+            with open(tmp, "w") as f:
+                f.write("new")
+        self.assertEqual(self.read(), "new")
+        self.assertEqual(os.listdir(self.dir), ["state"])
+
+    def test_keeps_file_on_error(self):
+        with self.assertRaises(RuntimeError):
+            with utils.atomic_file(self.path) as tmp:
+                with open(tmp, "w") as f:
+                    f.write("partial")
+                raise RuntimeError
+        self.assertEqual(self.read(), "old")
+        self.assertEqual(os.listdir(self.dir), ["state"])
+
+
+if __name__ == "__main__":
+    unittest.main()